@@ -0,0 +1,284 @@
+import argparse
+import functools
+import inspect
+import os
+import threading
+import time
+from types import SimpleNamespace
+from typing import TYPE_CHECKING, List, Tuple
+
+import numpy as np
+
+# torch and transformers are imported inside the functions that need them, so importing this
+# module (and the scripts that use it) stays cheap until a model is actually loaded.
+if TYPE_CHECKING:
+    import torch
+
+DEFAULT_MODEL = "dicta-il/BEREL_2.0"
+
+# BEREL is a BERT model, inputs longer than this are truncated.
+MAX_LENGTH = 512
+
+# Upper bound on padded tokens (batch size x longest member) in one forward pass.
+MAX_BATCH_TOKENS = 8192
+MAX_BATCH_SIZE = 128
+
+# "torch" is the fp32 PyTorch model, "int8" the same model with dynamically quantized linear layers,
+# "onnx" runs an exported graph with onnxruntime and "onnx-int8" a quantized copy of that graph.
+BACKENDS = ("torch", "int8", "onnx", "onnx-int8")
+ONNX_DIR = "onnx"
+# Part of the exported file names, bumped when the export changes so older graphs are exported again.
+ONNX_FORMAT = 3
+
+
+"""-------------------------------------------
+Groups texts of similar length into batches.
+
+The texts are sorted by token length and packed greedily, so a batch is
+only padded to a length close to that of all of its members, and large
+batches of short verses go through in one forward pass.
+
+Parameters:
+lengths (List[int]): The token length of every text.
+max_batch_tokens (int): The padded size limit of a batch.
+max_batch_size (int): The number of texts limit of a batch.
+
+Returns:
+List[List[int]]: The batches, as lists of indices into lengths.
+----------------------------------------------"""
+def length_batches(lengths: List[int], max_batch_tokens: int = MAX_BATCH_TOKENS,
+                   max_batch_size: int = MAX_BATCH_SIZE) -> List[List[int]]:
+    batches = []
+    batch, longest = [], 0
+    for i in sorted(range(len(lengths)), key=lengths.__getitem__):
+        padded_length = max(longest, lengths[i])
+        if batch and (padded_length * (len(batch) + 1) > max_batch_tokens or len(batch) >= max_batch_size):
+            batches.append(batch)
+            batch, padded_length = [], lengths[i]
+        batch.append(i)
+        longest = padded_length
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+# Averages the token embeddings of every sequence over its real tokens only, padding is masked out.
+def masked_mean(hidden: "torch.Tensor", attention_mask: "torch.Tensor") -> "torch.Tensor":
+    mask = attention_mask.unsqueeze(-1).to(hidden.dtype)
+    return (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+
+
+"""-------------------------------------------
+Embeds texts with BEREL.
+
+Parameters:
+texts (List[str]): The texts to embed.
+tokenizer: The BEREL tokenizer.
+model: The BEREL model.
+max_batch_tokens (int): The padded size limit of a batch.
+
+Returns:
+np.ndarray: A contiguous float32 matrix with one mean-pooled embedding per text, in input order.
+----------------------------------------------"""
+def get_embeddings(texts: List[str], tokenizer, model, max_batch_tokens: int = MAX_BATCH_TOKENS) -> np.ndarray:
+    import torch
+
+    embeddings = np.empty((len(texts), model.config.hidden_size), dtype=np.float32)
+    if not texts:
+        return embeddings
+
+    # Tokenize once without padding, each batch is padded on its own below.
+    encoded = tokenizer(list(texts), truncation=True, max_length=min(tokenizer.model_max_length, MAX_LENGTH))
+    lengths = [len(ids) for ids in encoded["input_ids"]]
+
+    for batch in length_batches(lengths, max_batch_tokens):
+        features = tokenizer.pad({key: [encoded[key][i] for i in batch] for key in encoded.keys()},
+                                 return_tensors="pt")
+        with torch.inference_mode():
+            hidden = model(**features).last_hidden_state
+        embeddings[batch] = masked_mean(hidden, features["attention_mask"]).float().numpy()
+
+    return embeddings
+
+
+class OnnxModel:
+    # Runs an exported BEREL graph with onnxruntime, called like the PyTorch model by get_embeddings.
+    def __init__(self, path: str, config):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("The onnx BEREL backends need onnxruntime, install it with 'pip install onnxruntime'.")
+        self.config = config
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [node.name for node in self.session.get_inputs()]
+
+    def __call__(self, **features):
+        import torch
+
+        feeds = {name: features[name].numpy().astype(np.int64) for name in self.input_names}
+        hidden = self.session.run(None, feeds)[0]
+        return SimpleNamespace(last_hidden_state=torch.from_numpy(hidden))
+
+
+# Exports BEREL to ONNX once, and a dynamically quantized copy of it if asked, returns the graph path.
+def export_onnx(model_name: str, tokenizer, quantize: bool = False) -> str:
+    import torch
+    from transformers import AutoModel
+
+    base = os.path.join(ONNX_DIR, f"{model_name.replace('/', '_')}.v{ONNX_FORMAT}")
+    path = base + ".onnx"
+    if not os.path.exists(path):
+        os.makedirs(ONNX_DIR, exist_ok=True)
+        model = AutoModel.from_pretrained(model_name)
+        model.eval()
+        dummy = tokenizer(["בראשית ברא אלהים"], return_tensors="pt")
+        # torch names the graph inputs by position in the order of BertModel.forward, which takes
+        # attention_mask before token_type_ids, unlike the tokenizer. Both come from the signature.
+        input_names = [name for name in inspect.signature(model.forward).parameters if name in dummy]
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+        dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+        torch.onnx.export(
+            model,
+            ({name: dummy[name] for name in input_names},),
+            path,
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=14,
+        )
+    if not quantize:
+        return path
+
+    quantized_path = base + ".int8.onnx"
+    if not os.path.exists(quantized_path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(path, quantized_path, weight_type=QuantType.QInt8)
+    return quantized_path
+
+
+"""-------------------------------------------
+Loads BEREL for inference on one of the BACKENDS.
+
+Parameters:
+model_name (str): The Hugging Face model name.
+tokenizer: The model's tokenizer, used to export the ONNX graph.
+backend (str): One of BACKENDS.
+
+Returns:
+A model get_embeddings can run.
+----------------------------------------------"""
+def load_model(model_name: str, tokenizer, backend: str = "torch"):
+    import torch
+    from transformers import AutoConfig, AutoModel
+
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown BEREL backend '{backend}', expected one of {', '.join(BACKENDS)}.")
+
+    if backend.startswith("onnx"):
+        # The PyTorch weights are only loaded for the one-time export, not kept in memory.
+        path = export_onnx(model_name, tokenizer, quantize=backend == "onnx-int8")
+        return OnnxModel(path, AutoConfig.from_pretrained(model_name))
+
+    model = AutoModel.from_pretrained(model_name)
+    model.eval()
+    if backend == "int8":
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+# The backend to run, BEREL_BACKEND or "torch" if not given.
+def resolve_backend(backend: str = None) -> str:
+    return backend or os.getenv("BEREL_BACKEND", "torch")
+
+
+_models = {}
+_models_lock = threading.Lock()
+
+
+"""-------------------------------------------
+Returns the tokenizer and model for a backend, loading them on the first call only.
+
+Every caller in the process shares the same instance. Calling it in a
+parent process before forking workers lets them share the loaded weights
+copy-on-write instead of each loading their own.
+
+Parameters:
+model_name (str): The Hugging Face model name.
+backend (str): One of BACKENDS, BEREL_BACKEND or "torch" if not given.
+
+Returns:
+Tuple: (tokenizer, model).
+----------------------------------------------"""
+def get_model(model_name: str = DEFAULT_MODEL, backend: str = None) -> Tuple[object, object]:
+    backend = resolve_backend(backend)
+    key = (model_name, backend)
+    with _models_lock:
+        if key not in _models:
+            tokenizer = get_tokenizer(model_name)
+            _models[key] = (tokenizer, load_model(model_name, tokenizer, backend))
+    return _models[key]
+
+
+# The shared tokenizer, loaded on first use. Much cheaper than get_model when only token counts are needed.
+@functools.lru_cache(maxsize=None)
+def get_tokenizer(model_name: str = DEFAULT_MODEL):
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(model_name)
+
+
+"""-------------------------------------------
+Compares the embeddings of a backend with the fp32 reference.
+
+Parameters:
+texts (List[str]): The texts to embed with both models.
+tokenizer: The BEREL tokenizer.
+reference: The fp32 PyTorch model.
+candidate: The model to check.
+
+Returns:
+Dict: The min and mean cosine similarity per text, and the time each model took.
+----------------------------------------------"""
+def parity_check(texts: List[str], tokenizer, reference, candidate) -> dict:
+    start = time.perf_counter()
+    expected = get_embeddings(texts, tokenizer, reference)
+    reference_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = get_embeddings(texts, tokenizer, candidate)
+    candidate_seconds = time.perf_counter() - start
+
+    cosine = np.sum(expected * actual, axis=1) / (
+        np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1) + 1e-12)
+    return {
+        "min_cosine": float(cosine.min()),
+        "mean_cosine": float(cosine.mean()),
+        "reference_seconds": reference_seconds,
+        "candidate_seconds": candidate_seconds,
+    }
+
+
+if __name__ == "__main__":
+    import textLoader
+    import verseChunker
+
+    parser = argparse.ArgumentParser(description="Checks a BEREL backend against the fp32 model.")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--backend", default="int8", choices=BACKENDS[1:])
+    parser.add_argument("--chapters", type=int, default=5)
+    parser.add_argument("--min-cosine", type=float, default=0.99)
+    args = parser.parse_args()
+
+    berel_tokenizer = get_tokenizer(args.model)
+    sources = [{"title": f"bereshit {i + 1}", "fileName": os.path.join("bereshit", f"bereshit {i + 1}.txt")}
+               for i in range(args.chapters)]
+    sample = [doc["text"] for doc in textLoader.load_sources(sources, chunk=verseChunker.VerseChunker().chunk)]
+
+    result = parity_check(sample, berel_tokenizer, load_model(args.model, berel_tokenizer, "torch"),
+                          load_model(args.model, berel_tokenizer, args.backend))
+    print(f"{args.backend}: min cosine {result['min_cosine']:.4f}, mean cosine {result['mean_cosine']:.4f}, "
+          f"{result['reference_seconds']:.2f}s fp32 vs {result['candidate_seconds']:.2f}s on {len(sample)} chunks")
+    if result["min_cosine"] < args.min_cosine:
+        raise SystemExit(f"{args.backend} is below the {args.min_cosine} cosine parity threshold.")
@@ -0,0 +1,175 @@
+import asyncio
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Dict, List, Optional
+
+from cohereClient import get_client
+
+
+class SearchQueries:
+    # Emitted once the search queries of a message are planned.
+    def __init__(self, queries: List[str]):
+        self.queries = queries
+
+
+class RetrievedDocuments:
+    # Emitted once the documents of a message are retrieved, before the answer streams.
+    def __init__(self, documents: List[Dict[str, str]]):
+        self.documents = documents
+
+
+class OffTopic:
+    # Emitted instead of an answer when the message needs no retrieval.
+    def __init__(self, text: str):
+        self.text = text
+
+
+class ConversationState:
+    # The per-conversation state. The lock keeps the turns of one conversation in order,
+    # different conversations run concurrently.
+    def __init__(self, conversation_id: str):
+        self.conversation_id = conversation_id
+        self.lock = asyncio.Lock()
+        self.turns = 0
+        self.last_active = time.time()
+        # None while Cohere keeps the history under the conversation id. A conversation that opened
+        # with a cached answer has no history on Cohere's side, so it is kept here and sent along.
+        self.history: Optional[List[Dict[str, str]]] = None
+
+
+class ChatEngine:
+    """-------------------------------------------
+    An asyncio chat engine over a Chatbot.
+
+    Query planning, retrieval and the streaming co.chat call are blocking,
+    so each runs on a bounded thread pool and the stream events are handed
+    back to the event loop as they arrive. One process can then serve many
+    conversations at once, each keyed by its conversation_id.
+
+    Parameters:
+    chatbot (ragPipeline.Chatbot): The chatbot to run.
+    max_workers (int): The most blocking calls running at the same time.
+    ----------------------------------------------"""
+    def __init__(self, chatbot, max_workers: int = 32):
+        self.chatbot = chatbot
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.conversations: Dict[str, ConversationState] = {}
+
+    # Returns the state of a conversation, starting a new one if the id is unknown or None.
+    def conversation(self, conversation_id: Optional[str] = None) -> ConversationState:
+        conversation_id = conversation_id or str(uuid.uuid4())
+        if conversation_id not in self.conversations:
+            self.conversations[conversation_id] = ConversationState(conversation_id)
+        return self.conversations[conversation_id]
+
+    # Forgets the conversations that were idle for longer than max_idle seconds.
+    def prune(self, max_idle: float = 3600.0) -> None:
+        now = time.time()
+        for conversation_id, state in list(self.conversations.items()):
+            if now - state.last_active > max_idle and not state.lock.locked():
+                del self.conversations[conversation_id]
+
+    async def run_blocking(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def plan_queries(self, message: str) -> List[str]:
+        return await self.run_blocking(self.chatbot.planner.plan, message)
+
+    async def retrieve(self, queries: List[str]) -> List[Dict[str, str]]:
+        return await self.run_blocking(self.chatbot.retrieve_queries, queries)
+
+    """-------------------------------------------
+    Streams a co.chat answer without blocking the event loop.
+
+    Parameters:
+    conversation_id (str): The Cohere conversation id.
+    message (str): The user's message.
+    documents (List[Dict[str, str]]): The retrieved documents.
+    chat_history (List[Dict[str, str]]): The earlier turns, sent instead of the conversation id if given.
+
+    Yields:
+    Event: The stream events, then the finished StreamingChat response.
+    ----------------------------------------------"""
+    async def stream_chat(self, conversation_id: str, message: str, documents: List[Dict[str, str]],
+                          chat_history: Optional[List[Dict[str, str]]] = None) -> AsyncIterator[object]:
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        done = object()
+        history = {"conversation_id": conversation_id} if chat_history is None else {"chat_history": chat_history}
+
+        def produce():
+            try:
+                response = get_client().chat(message=message, documents=documents, stream=True,
+                                             **history, **self.chatbot.stream_options())
+                for event in response:
+                    loop.call_soon_threadsafe(queue.put_nowait, event)
+                loop.call_soon_threadsafe(queue.put_nowait, response)
+            except Exception as error:
+                loop.call_soon_threadsafe(queue.put_nowait, error)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, done)
+
+        producer = loop.run_in_executor(self.executor, produce)
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                await producer
+                raise item
+            yield item
+        await producer
+
+    """-------------------------------------------
+    Answers a message in a conversation.
+
+    Parameters:
+    conversation_id (str): The conversation, None to start a new one.
+    message (str): The user's message.
+
+    Yields:
+    Event: SearchQueries, RetrievedDocuments, the co.chat stream events and
+    the finished response, or OffTopic when the message needs no retrieval.
+    An opening message the chatbot's response cache knows is replayed from
+    it with the same events, under this conversation's id.
+    ----------------------------------------------"""
+    async def respond(self, conversation_id: Optional[str], message: str) -> AsyncIterator[object]:
+        state = self.conversation(conversation_id)
+        async with state.lock:
+            state.last_active = time.time()
+            # Later turns are answered by co.chat with the conversation history, so only the first is cached.
+            cacheable = state.turns == 0
+            if cacheable:
+                embedding, cached = await self.run_blocking(self.chatbot.cached_answer, message)
+                if cached is not None:
+                    yield SearchQueries(cached.queries)
+                    yield RetrievedDocuments(cached.documents)
+                    for event in cached.events(state.conversation_id):
+                        yield event
+                    state.history = [{"role": "USER", "message": message},
+                                     {"role": "CHATBOT", "message": cached.text}]
+                    state.turns += 1
+                    state.last_active = time.time()
+                    return
+
+            queries = await self.plan_queries(message)
+            if not queries:
+                yield OffTopic(self.chatbot.off_topic_message)
+                return
+            yield SearchQueries(queries)
+
+            documents = await self.retrieve(queries)
+            yield RetrievedDocuments(documents)
+
+            response = None
+            async for event in self.stream_chat(state.conversation_id, message, documents, state.history):
+                response = event
+                yield event
+            if state.history is not None:
+                state.history = state.history + [{"role": "USER", "message": message},
+                                                 {"role": "CHATBOT", "message": getattr(response, "text", "")}]
+            state.turns += 1
+            if cacheable:
+                self.chatbot.store_answer(message, embedding, queries, documents, response)
+            state.last_active = time.time()
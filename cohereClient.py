@@ -0,0 +1,12 @@
+import functools
+import os
+
+API_KEY = '2ELFLZKqLyZi5bLIGwt1kDBMpoAT9ch44DHfycAm'  # This is your trial API key
+
+
+# The shared Cohere client, created on first use instead of at import.
+# Point CO_API_URL at a local fake server for testing.
+@functools.lru_cache(maxsize=None)
+def get_client():
+    import cohere
+    return cohere.Client(API_KEY, api_url=os.getenv("CO_API_URL"))
@@ -0,0 +1,214 @@
+import hashlib
+import json
+import os
+from typing import List, Dict, Optional, Tuple, Callable
+
+import numpy as np
+
+import textLoader
+import vectorIndex
+
+SNAPSHOT_ROOT = "snapshots"
+
+DOCS_FILE = "docs.json"
+EMBEDDINGS_FILE = "embeddings.npy"
+INDEX_FILE = "index.bin"
+META_FILE = "meta.json"
+
+
+# Builds the snapshot directory for an embedding model, dimension and list of sources.
+# The sources and the chunking settings are fingerprinted so two scripts with different
+# corpora, or a chunker change, never reuse a snapshot.
+def snapshot_path(model: str, dim: int, sources: List[Dict[str, str]], root: str = SNAPSHOT_ROOT,
+                  settings: Optional[Dict] = None) -> str:
+    fingerprint = hashlib.sha1(
+        json.dumps([sources, settings or {}], sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()[:12]
+    slug = model.replace("/", "_").replace("\\", "_")
+    return os.path.join(root, f"{slug}-{dim}-{fingerprint}")
+
+
+# A short hash of the docs and the embedding matrix, changes whenever the snapshot content does.
+def snapshot_version(docs: List[Dict[str, str]], embs: np.ndarray) -> str:
+    digest = hashlib.sha1(json.dumps(docs, ensure_ascii=False).encode("utf-8"))
+    digest.update(np.ascontiguousarray(embs, dtype=np.float32).tobytes())
+    return digest.hexdigest()[:16]
+
+
+# Content hash of a source file.
+def file_hash(file_name: str) -> str:
+    digest = hashlib.sha256()
+    with open(textLoader.local_path(file_name), "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Content hash of every source file, keyed by fileName.
+def file_hashes(sources: List[Dict[str, str]]) -> Dict[str, str]:
+    return {source["fileName"]: file_hash(source["fileName"]) for source in sources}
+
+
+# Content hash of a single chunk record.
+def chunk_hash(doc: Dict[str, str]) -> str:
+    return hashlib.sha1((doc["title"] + "\0" + doc["text"]).encode("utf-8")).hexdigest()
+
+
+"""-------------------------------------------
+Saves the chunk list, the embedding matrix and the vector index together.
+
+The meta file is written last, so a snapshot that was interrupted halfway
+is never picked up by load().
+
+Parameters:
+path (str): The snapshot directory (see snapshot_path).
+docs (List[Dict[str, str]]): The chunk records.
+embs: The embeddings, one row per chunk.
+index (vectorIndex.VectorIndex): The built index.
+model (str): The embedding model name.
+dim (int): The embedding dimension.
+extra (Dict): Additional fields to keep in the meta file.
+
+Returns:
+Dict: The meta data that was written.
+----------------------------------------------"""
+def save(path: str, docs: List[Dict[str, str]], embs, index, model: str, dim: int,
+         extra: Optional[Dict] = None) -> Dict:
+    os.makedirs(path, exist_ok=True)
+    meta_file = os.path.join(path, META_FILE)
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+
+    embs_file = os.path.join(path, EMBEDDINGS_FILE)
+    # Embeddings memory-mapped from this very file are already saved, and must not be truncated under the map.
+    if not (isinstance(embs, np.memmap) and os.path.exists(embs_file) and os.path.samefile(embs.filename, embs_file)):
+        embs = np.ascontiguousarray(embs, dtype=np.float32).reshape(len(docs), dim)
+        np.save(embs_file, embs)
+    index.save_index(os.path.join(path, INDEX_FILE))
+    with open(os.path.join(path, DOCS_FILE), "w", encoding="utf-8") as f:
+        json.dump(docs, f, ensure_ascii=False)
+
+    meta = {
+        "model": model,
+        "dim": dim,
+        "count": len(docs),
+        "max_elements": index.get_max_elements(),
+        "index": index.kind,
+        "index_params": index.params(),
+        "version": snapshot_version(docs, embs),
+    }
+    meta.update(extra or {})
+    tmp_file = meta_file + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp_file, meta_file)
+    return meta
+
+
+# Reads only the meta file of a snapshot, None if there is no complete snapshot at path.
+def load_meta(path: str) -> Optional[Dict]:
+    meta_file = os.path.join(path, META_FILE)
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file, encoding="utf-8") as f:
+        return json.load(f)
+
+
+# Memory-maps the embedding matrix of a snapshot, the rows are only read from disk when used.
+def load_embeddings(path: str) -> np.ndarray:
+    return np.load(os.path.join(path, EMBEDDINGS_FILE), mmap_mode="r")
+
+
+"""-------------------------------------------
+Loads a snapshot written by save().
+
+The embedding matrix is memory-mapped instead of read into memory, and the
+index is loaded into the same kind of index it was saved from.
+
+Parameters:
+path (str): The snapshot directory.
+model (str): The embedding model the caller expects.
+dim (int): The embedding dimension the caller expects.
+
+Returns:
+Tuple: (docs, embs, index, meta), or None if there is no matching snapshot.
+----------------------------------------------"""
+def load(path: str, model: str, dim: int
+         ) -> Optional[Tuple[List[Dict[str, str]], np.ndarray, vectorIndex.VectorIndex, Dict]]:
+    meta = load_meta(path)
+    if meta is None or meta["model"] != model or meta["dim"] != dim:
+        return None
+
+    with open(os.path.join(path, DOCS_FILE), encoding="utf-8") as f:
+        docs = json.load(f)
+    embs = load_embeddings(path)
+
+    # Snapshots from before the index kind was recorded hold an hnswlib graph.
+    index = vectorIndex.create_index(meta.get("index", vectorIndex.HnswIndex.kind), dim, **meta.get("index_params", {}))
+    index.load_index(os.path.join(path, INDEX_FILE), max_elements=meta["max_elements"])
+
+    return docs, embs, index, meta
+
+
+"""-------------------------------------------
+Brings a restored snapshot up to date with the source files on disk.
+
+Only the files whose content hash changed are chunked again. Chunks that
+are still present keep their label and embedding, chunks that disappeared
+are tombstoned with mark_deleted, and only new or edited chunks are
+embedded and added to the existing index.
+
+Parameters:
+docs (List[Dict[str, str]]): The chunk records, the list position is the index label.
+embs: The embeddings, one row per chunk.
+index (vectorIndex.VectorIndex): The index loaded from the snapshot.
+deleted (List[int]): Labels that were already tombstoned.
+files (Dict[str, str]): The file hashes the snapshot was built from.
+sources (List[Dict[str, str]]): The current sources.
+load_source (Callable): Chunks a single source into records.
+embed_texts (Callable): Embeds a list of texts.
+
+Returns:
+Tuple: (docs, embs, deleted, files, stats), or None if nothing changed.
+----------------------------------------------"""
+def refresh(docs: List[Dict[str, str]], embs, index, deleted: List[int], files: Dict[str, str],
+            sources: List[Dict[str, str]], load_source: Callable, embed_texts: Callable):
+    current_files = file_hashes(sources)
+    changed = [source for source in sources if files.get(source["fileName"]) != current_files[source["fileName"]]]
+    stale_files = {source["fileName"] for source in changed} | (set(files) - set(current_files))
+    if not stale_files:
+        return None
+
+    deleted = set(deleted)
+    reusable = {}
+    for label, doc in enumerate(docs):
+        if label not in deleted and doc["fileName"] in stale_files:
+            reusable.setdefault((doc["fileName"], chunk_hash(doc)), []).append(label)
+
+    new_docs = []
+    reused = 0
+    for source in changed:
+        for doc in load_source(source):
+            labels = reusable.get((doc["fileName"], chunk_hash(doc)))
+            if labels:
+                labels.pop()
+                reused += 1
+            else:
+                new_docs.append(doc)
+
+    tombstones = [label for labels in reusable.values() for label in labels]
+    for label in tombstones:
+        index.mark_deleted(label)
+        deleted.add(label)
+
+    if new_docs:
+        new_embs = np.asarray(embed_texts([doc["text"] for doc in new_docs]), dtype=np.float32)
+        start = len(docs)
+        if index.get_max_elements() < start + len(new_docs):
+            index.resize_index(start + len(new_docs))
+        index.add_items(new_embs, list(range(start, start + len(new_docs))))
+        docs = docs + new_docs
+        embs = np.vstack([np.asarray(embs, dtype=np.float32).reshape(start, -1), new_embs])
+
+    stats = {"embedded": len(new_docs), "deleted": len(tombstones), "reused": reused}
+    return docs, embs, sorted(deleted), current_files, stats
@@ -0,0 +1,100 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Callable
+
+# Cohere accepts at most 96 texts in a single embed request.
+MAX_TEXTS_PER_REQUEST = 96
+
+
+# True if the error is the API telling us to slow down.
+def is_rate_limited(error: Exception) -> bool:
+    if getattr(error, "http_status", None) == 429:
+        return True
+    message = str(error).lower()
+    return "429" in message or "rate limit" in message or "too many requests" in message
+
+
+# True if the API rejected the request because the batch is over a per-request limit. Only
+# 400 and 413 responses count, a local error must not split the batch down to single texts.
+def is_too_large(error: Exception) -> bool:
+    status = getattr(error, "http_status", None)
+    if status == 413:
+        return True
+    if status != 400:
+        return False
+    message = str(error).lower()
+    return "too many texts" in message or "too large" in message or "too long" in message
+
+
+# The Retry-After header of a rate-limit error in seconds, if the server sent one.
+def retry_after(error: Exception):
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After") or headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class EmbedPipeline:
+    """-------------------------------------------
+    Embeds texts with a bounded number of batches in flight.
+
+    Parameters:
+    embed_batch (Callable): Embeds one list of texts, returns one vector per text.
+    batch_size (int): Texts per request, capped at MAX_TEXTS_PER_REQUEST.
+    max_in_flight (int): How many requests may run at the same time.
+    max_retries (int): Retries of a single batch on rate-limit errors.
+    base_delay (float): First backoff delay in seconds, doubled on every retry.
+    max_delay (float): Upper bound of a single backoff delay.
+    ----------------------------------------------"""
+    def __init__(self, embed_batch: Callable[[List[str]], List[List[float]]], batch_size: int = 90,
+                 max_in_flight: int = 4, max_retries: int = 6, base_delay: float = 1.0, max_delay: float = 30.0):
+        self.embed_batch = embed_batch
+        self.batch_size = max(1, min(batch_size, MAX_TEXTS_PER_REQUEST))
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    """-------------------------------------------
+    Embeds the texts and returns the vectors in the order of the texts.
+
+    Parameters:
+    texts (List[str]): The texts to embed.
+
+    Returns:
+    List[List[float]]: One embedding per text.
+    ----------------------------------------------"""
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        batches = [texts[i: i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        if not batches:
+            return []
+
+        with ThreadPoolExecutor(max_workers=min(self.max_in_flight, len(batches))) as executor:
+            results = list(executor.map(self.embed_with_retry, batches))
+
+        embs = []
+        for batch_embs in results:
+            embs.extend(batch_embs)
+        return embs
+
+    # Embeds one batch, backing off on rate limits and splitting it when it is over the request limit.
+    def embed_with_retry(self, batch: List[str]) -> List[List[float]]:
+        attempt = 0
+        while True:
+            try:
+                return list(self.embed_batch(batch))
+            except Exception as error:
+                if is_too_large(error) and len(batch) > 1:
+                    # Later calls to embed() start from the smaller size straight away.
+                    self.batch_size = max(1, min(self.batch_size, len(batch) // 2))
+                    middle = len(batch) // 2
+                    return self.embed_with_retry(batch[:middle]) + self.embed_with_retry(batch[middle:])
+                if not is_rate_limited(error) or attempt >= self.max_retries:
+                    raise
+                delay = retry_after(error)
+                if delay is None:
+                    delay = min(self.max_delay, self.base_delay * 2 ** attempt) * (0.5 + random.random() / 2)
+                time.sleep(delay)
+                attempt += 1
@@ -0,0 +1,113 @@
+from typing import List
+
+import numpy as np
+
+import berelEncoder
+import embedPipeline
+import verseChunker
+from cohereClient import get_client
+
+
+class Embedder:
+    """-------------------------------------------
+    The interface of an embedding model the retrieval pipeline is built on.
+
+    Attributes:
+    model (str): The model name.
+    dim (int): The embedding dimension.
+    ----------------------------------------------"""
+    model = None
+    dim = None
+
+    # The name the vectors are keyed by in the snapshot path and the query cache.
+    def key(self) -> str:
+        return self.model
+
+    # The chunker whose chunks fit the model's input.
+    def chunker(self) -> verseChunker.VerseChunker:
+        return verseChunker.VerseChunker()
+
+    # Embeds the chunk texts, one row per text.
+    def embed_documents(self, texts: List[str]) -> np.ndarray:
+        raise NotImplementedError
+
+    # Embeds search queries, one row per query.
+    def embed_queries(self, queries: List[str]) -> np.ndarray:
+        raise NotImplementedError
+
+
+class CohereEmbedder(Embedder):
+    """-------------------------------------------
+    Embeds with the Cohere API.
+
+    Parameters:
+    model (str): The Cohere embedding model.
+    dim (int): Its embedding dimension.
+    batch_size (int): Texts per embed request.
+    max_in_flight (int): How many embed requests may run at the same time.
+    ----------------------------------------------"""
+    def __init__(self, model: str = "embed-multilingual-v3.0", dim: int = 1024, batch_size: int = 90,
+                 max_in_flight: int = 4):
+        self.model = model
+        self.dim = dim
+        self.pipeline = embedPipeline.EmbedPipeline(self.embed_batch, batch_size=batch_size,
+                                                    max_in_flight=max_in_flight)
+
+    # Several batches are sent concurrently.
+    def embed_documents(self, texts: List[str]) -> np.ndarray:
+        return np.asarray(self.pipeline.embed(texts), dtype=np.float32).reshape(len(texts), self.dim)
+
+    # Embeds a single batch, called by the embed pipeline.
+    def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        return get_client().embed(
+            texts=texts,
+            model=self.model,
+            input_type="search_document"
+        ).embeddings
+
+    def embed_queries(self, queries: List[str]) -> np.ndarray:
+        return np.asarray(get_client().embed(
+            texts=queries,
+            model=self.model,
+            input_type="search_query"
+        ).embeddings, dtype=np.float32)
+
+
+class BerelEmbedder(Embedder):
+    """-------------------------------------------
+    Embeds locally with BEREL, batched by token length and mean-pooled over the real tokens.
+
+    Parameters:
+    model (str): The Hugging Face model name.
+    dim (int): Its hidden size.
+    backend (str): One of berelEncoder.BACKENDS, BEREL_BACKEND or "torch" if not given.
+    max_tokens (int): The chunk size, special tokens included.
+    ----------------------------------------------"""
+    def __init__(self, model: str = berelEncoder.DEFAULT_MODEL, dim: int = 768, backend: str = None,
+                 max_tokens: int = 256):
+        self.model = model
+        self.dim = dim
+        self.backend = backend
+        self.max_tokens = max_tokens
+        self._chunker = None
+
+    # The backends give slightly different vectors, so they do not share snapshots or cached queries.
+    def key(self) -> str:
+        return f"{self.model}-{berelEncoder.resolve_backend(self.backend)}"
+
+    # Verse-aligned chunks that fit the BEREL input once the special tokens are added.
+    # Built on first use, so creating the embedder does not load the tokenizer.
+    def chunker(self) -> verseChunker.VerseChunker:
+        if self._chunker is None:
+            tokenizer = berelEncoder.get_tokenizer(self.model)
+            self._chunker = verseChunker.VerseChunker(verseChunker.TokenCounter(tokenizer),
+                                                      max_tokens=self.max_tokens - tokenizer.num_special_tokens_to_add())
+        return self._chunker
+
+    def embed_documents(self, texts: List[str]) -> np.ndarray:
+        tokenizer, model = berelEncoder.get_model(self.model, self.backend)
+        return berelEncoder.get_embeddings(texts, tokenizer, model)
+
+    # BEREL has no separate query mode, queries are embedded like documents.
+    def embed_queries(self, queries: List[str]) -> np.ndarray:
+        return self.embed_documents(queries)
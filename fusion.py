@@ -0,0 +1,53 @@
+from typing import List, Callable, Optional
+
+# The usual RRF constant, damps the weight of the very top ranks.
+RRF_K = 60
+
+
+"""-------------------------------------------
+Fuses several rankings of chunk ids with reciprocal rank fusion.
+
+Every id scores the sum of 1 / (k + rank) over the rankings it appears
+in, so a chunk found by several queries rises to the top and appears
+only once in the result.
+
+Parameters:
+rankings (List[List[int]]): The ranked chunk ids of every query, best first.
+k (int): The RRF constant.
+
+Returns:
+List[int]: The distinct chunk ids, best fused score first.
+----------------------------------------------"""
+def reciprocal_rank_fusion(rankings: List[List[int]], k: int = RRF_K) -> List[int]:
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            doc_id = int(doc_id)
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=lambda doc_id: -scores[doc_id])
+
+
+"""-------------------------------------------
+Keeps the best chunks that fit in a token budget.
+
+Parameters:
+doc_ids (List[int]): The chunk ids, best first.
+count_tokens (Callable): The token count of a chunk id.
+max_tokens (int): The budget of all kept chunks together.
+max_docs (int): An optional cap on the number of chunks.
+
+Returns:
+List[int]: The kept chunk ids, in the given order. The first chunk is always kept.
+----------------------------------------------"""
+def cap_to_budget(doc_ids: List[int], count_tokens: Callable[[int], int], max_tokens: int,
+                  max_docs: Optional[int] = None) -> List[int]:
+    kept, used = [], 0
+    for doc_id in doc_ids:
+        if max_docs is not None and len(kept) >= max_docs:
+            break
+        tokens = count_tokens(doc_id)
+        if kept and used + tokens > max_tokens:
+            continue
+        kept.append(doc_id)
+        used += tokens
+    return kept
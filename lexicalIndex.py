@@ -0,0 +1,157 @@
+import math
+import re
+import unicodedata
+from collections import Counter
+from typing import Dict, List, Optional, Set, Tuple
+
+# Niqqud and cantillation marks, dropped so pointed and unpointed text match.
+HEBREW_MARKS = re.compile(r"[֑-ֽֿ-ׇ]")
+MAQAF = "־"
+FINAL_LETTERS = str.maketrans("ךםןףץ", "כמנפצ")
+TOKEN = re.compile(r"\w+(?:-\w+)*")
+# A chapter reference as it is indexed, e.g. פרק-יב.
+CHAPTER_REFERENCE = re.compile(r"^פרק-[א-ת]+$")
+
+# The one-letter prefixes of Hebrew (ו ה ב כ ל מ ש), which attach to the next word, e.g. ובבית.
+PREFIX_LETTERS = "והבכלמש"
+MAX_PREFIXES = 2
+MIN_STEM = 2
+
+
+# Folds a text to the form that is indexed: no niqqud, no final letter forms, maqaf as a hyphen.
+def normalize_hebrew(text: str) -> str:
+    text = unicodedata.normalize("NFC", text).replace(MAQAF, "-")
+    text = HEBREW_MARKS.sub("", text)
+    return text.translate(FINAL_LETTERS).casefold()
+
+
+# The normalized words of a text, a hyphenated word like פרק-יב is kept whole.
+def tokenize(text: str) -> List[str]:
+    return TOKEN.findall(normalize_hebrew(text))
+
+
+# The terms a word is indexed under: the word itself, its parts if hyphenated,
+# and the stems left after removing up to MAX_PREFIXES prefix letters.
+def expand(token: str) -> Set[str]:
+    terms = {token}
+    if "-" in token:
+        terms.update(part for part in token.split("-") if part)
+    for term in list(terms):
+        stem = term
+        for _ in range(MAX_PREFIXES):
+            if len(stem) - 1 < MIN_STEM or stem[0] not in PREFIX_LETTERS:
+                break
+            stem = stem[1:]
+            terms.add(stem)
+    return terms
+
+
+class BM25Index:
+    """-------------------------------------------
+    An in-process inverted index with BM25 scoring.
+
+    Text is folded with normalize_hebrew and every word is indexed under
+    its prefix-stripped stems too, so ואברהם and לאברהם both match
+    אברהם. A hyphenated word such as פרק-יב is also indexed whole, which
+    makes chapter lookups exact.
+
+    Parameters:
+    k1 (float): The term frequency saturation.
+    b (float): How much the chunk length normalizes the term frequency.
+    ----------------------------------------------"""
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.lengths: Dict[int, int] = {}
+        self.total_length = 0
+
+    def add(self, doc_id: int, text: str) -> None:
+        tokens = tokenize(text)
+        counts = Counter(term for token in tokens for term in expand(token))
+        for term, count in counts.items():
+            self.postings.setdefault(term, {})[doc_id] = count
+        self.lengths[doc_id] = len(tokens)
+        self.total_length += len(tokens)
+
+    # Builds the index over the given chunks, skipping the deleted ones.
+    def build(self, docs: List[Dict[str, str]], deleted=()) -> None:
+        deleted = set(deleted)
+        self.postings, self.lengths, self.total_length = {}, {}, 0
+        for doc_id, doc in enumerate(docs):
+            if doc_id not in deleted:
+                self.add(doc_id, doc["text"])
+
+    # The terms a query word is looked up under. Chunks are indexed under the stems of their
+    # words, so the word itself already matches its prefixed forms. Its own stems are only
+    # tried if the word is not indexed, since they drift (הבל would match בבל through בל).
+    def query_terms(self, token: str) -> Set[str]:
+        if token in self.postings:
+            return {token}
+        for term in sorted(expand(token), key=len, reverse=True):
+            if term in self.postings:
+                return {term}
+        return set()
+
+    def idf(self, term: str) -> float:
+        frequency = len(self.postings.get(term, ()))
+        return math.log(1 + (len(self.lengths) - frequency + 0.5) / (frequency + 0.5))
+
+    # The BM25 score of every chunk that contains at least one query term.
+    def scores(self, query: str) -> Dict[int, float]:
+        if not self.lengths:
+            return {}
+        average_length = self.total_length / len(self.lengths)
+        terms = {term for token in tokenize(query) for term in self.query_terms(token)}
+        scores = {}
+        for term in terms:
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = self.idf(term)
+            for doc_id, count in postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[doc_id] / average_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * count * (self.k1 + 1) / (count + norm)
+        return scores
+
+    # The best k chunks for the query, as (doc_id, score), best first.
+    def search(self, query: str, k: int) -> List[Tuple[int, float]]:
+        scores = self.scores(query)
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:k]
+
+    """-------------------------------------------
+    Answers an explicit reference from the index alone.
+
+    Only a query with a chapter reference such as פרק-יב qualifies, with at
+    most max_terms words, e.g. בראשית פרק-ו or a verse, פרק-ו ט. When every
+    word is found in the same few chunks, those chunks are the whole answer
+    and the dense search and the rerank can be skipped. Other short queries
+    are not lookups even if their words are rare: a rare word is not the
+    passage the query asks about (מה חלם יוסף matches chapter 42, not 37).
+
+    Parameters:
+    query (str): The search query.
+    limit (int): The most chunks a lookup may return.
+    max_terms (int): The longest query treated as a lookup.
+
+    Returns:
+    List[int]: The matching chunk ids by BM25 score, or None if the query is not a lookup.
+    ----------------------------------------------"""
+    def lookup(self, query: str, limit: int, max_terms: int = 3) -> Optional[List[int]]:
+        tokens = tokenize(query)
+        if not tokens or len(tokens) > max_terms:
+            return None
+        if not any(CHAPTER_REFERENCE.match(term) for token in tokens for term in expand(token)):
+            return None
+        matches = None
+        for token in tokens:
+            docs = set()
+            for term in self.query_terms(token):
+                docs.update(self.postings.get(term, ()))
+            matches = docs if matches is None else matches & docs
+            if not matches:
+                return None
+        if len(matches) > limit:
+            return None
+        scores = self.scores(query)
+        return sorted(matches, key=lambda doc_id: (-scores.get(doc_id, 0.0), doc_id))
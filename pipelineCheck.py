@@ -0,0 +1,201 @@
+import argparse
+import hashlib
+import os
+import shutil
+import tempfile
+from typing import List
+
+import numpy as np
+
+import embedders
+import fusion
+import lexicalIndex
+import ragPipeline
+import vectorIndex
+import verseChunker
+
+
+class HashEmbedder(embedders.Embedder):
+    """-------------------------------------------
+    A deterministic embedder without a model, for checking the pipeline offline.
+
+    Every word is hashed to a random direction and a text is the sum of its
+    words, so texts that share words are close. Counts the texts it embeds.
+
+    Parameters:
+    dim (int): The embedding dimension.
+    ----------------------------------------------"""
+    def __init__(self, dim: int = 64):
+        self.model = "hash-check"
+        self.dim = dim
+        self.embedded = 0
+
+    def vector(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in lexicalIndex.tokenize(text):
+            seed = int(hashlib.md5(word.encode("utf-8")).hexdigest()[:8], 16)
+            vector += np.random.default_rng(seed).normal(size=self.dim).astype(np.float32)
+        return vector
+
+    def embed_documents(self, texts: List[str]) -> np.ndarray:
+        self.embedded += len(texts)
+        return np.vstack([self.vector(text) for text in texts]) if texts else np.empty((0, self.dim), np.float32)
+
+    def embed_queries(self, queries: List[str]) -> np.ndarray:
+        return np.vstack([self.vector(query) for query in queries])
+
+
+class Checks:
+    # Collects the failed checks, so one run reports all of them.
+    def __init__(self):
+        self.failed = []
+        self.passed = 0
+
+    def check(self, condition: bool, message: str) -> None:
+        if condition:
+            self.passed += 1
+        else:
+            self.failed.append(message)
+            print(f"FAILED: {message}")
+
+
+def check_chunker(checks: Checks) -> None:
+    chunker = verseChunker.VerseChunker(max_tokens=10, overlap_tokens=4)
+    verses = [(i, f"v{i}", tokens) for i, tokens in enumerate([3, 2, 4, 1, 3, 5, 2, 2, 3], start=1)]
+    windows = chunker.pack(verses, header_tokens=2)
+    checks.check(all(2 + sum(unit[2] for unit in window) <= 10 for window in windows), "pack keeps the budget")
+    checks.check(len(windows) > 1 and sorted({unit for window in windows for unit in window}) == verses,
+                 "pack covers every verse")
+    for previous, window in zip(windows, windows[1:]):
+        shared = [unit for unit in window if unit in previous]
+        checks.check(shared == previous[len(previous) - len(shared):], "the overlap is the end of the previous chunk")
+        checks.check(sum(unit[2] for unit in shared) <= 4, "the overlap keeps its budget")
+        checks.check(len(shared) < len(previous), "a chunk does not repeat the whole previous one")
+
+
+def check_fusion(checks: Checks) -> None:
+    checks.check(fusion.reciprocal_rank_fusion([[1, 2, 3], [3, 1]]) == [1, 3, 2], "RRF ranks shared hits first")
+    tokens = {1: 50, 2: 30, 3: 10, 4: 60}
+    checks.check(fusion.cap_to_budget([4, 1, 2, 3], tokens.get, 40) == [4],
+                 "cap_to_budget always keeps the first chunk")
+    checks.check(fusion.cap_to_budget([2, 1, 3], tokens.get, 40) == [2, 3],
+                 "cap_to_budget skips a chunk over the budget and keeps looking")
+    checks.check(fusion.cap_to_budget([3, 2, 1], tokens.get, 100, max_docs=2) == [3, 2], "cap_to_budget max_docs")
+
+
+def check_lexical(checks: Checks) -> None:
+    index = lexicalIndex.BM25Index()
+    index.build([{"text": "בראשית פרק-יב\n\nויאמר ה' אל אַבְרָם לך לך"}, {"text": "ויבא אברם ושרי ארצה כנען"},
+                 {"text": "בראשית פרק-יג\n\nויעל אברם ממצרים"}, {"text": "והארץ היתה תהו ובהו"}])
+    checks.check(set(index.scores("אברם")) == {0, 1, 2}, "niqqud is folded and prefixed words match")
+    checks.check(set(index.scores("לאברם")) == {0, 1, 2}, "a prefixed query word matches its stem")
+    checks.check(set(index.scores("הבל")) == set(), "a known word is not stemmed further")
+    checks.check(index.lookup("פרק-יב", 5) == [0] and index.lookup("בפרק-יג", 5) == [2], "chapter lookups")
+    checks.check(index.lookup("אברם", 5) is None, "a rare word is not a lookup")
+    index.build([{"text": "אברם"}, {"text": "אברם"}], deleted=[0])
+    checks.check(set(index.scores("אברם")) == {1}, "deleted chunks are not indexed")
+
+
+def check_exact_index(checks: Checks) -> None:
+    vectors = vectorIndex.normalize(np.random.default_rng(0).normal(size=(200, 32)).astype(np.float32))
+    deleted = list(range(0, 200, 7))
+    for dtype in vectorIndex.STORAGE_DTYPES:
+        index = vectorIndex.create_index("exact", 32, dtype=dtype)
+        index.build(vectors)
+        for label in deleted:
+            index.mark_deleted(label)
+        labels, distances = index.knn_query(vectors[:20], k=10)
+        checks.check(not set(labels.ravel().tolist()) & set(deleted), f"{dtype}: deleted labels are not returned")
+        checks.check(bool(np.all(np.diff(distances, axis=1) >= -1e-6)), f"{dtype}: nearest first")
+        if dtype != "float32":
+            labels, _ = vectorIndex.rescore(vectors, vectors[:20], index.knn_query(vectors[:20], k=40)[0], 10)
+        live = [i for i in range(20) if i not in deleted]
+        checks.check(all(int(labels[i][0]) == i for i in live), f"{dtype}: a vector finds itself first")
+
+
+"""-------------------------------------------
+Runs Documents.lei() on a copy of a few chapters through a chapter edit and
+the storage and index kind switches, with the hash embedder.
+
+Parameters:
+checks (Checks): Collects the results.
+chapters (int): How many chapters to copy.
+----------------------------------------------"""
+def check_documents(checks: Checks, chapters: int) -> None:
+    work = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.makedirs(os.path.join(work, "bereshit"))
+        for i in range(1, chapters + 1):
+            shutil.copy(os.path.join(cwd, "bereshit", f"bereshit {i}.txt"), os.path.join(work, "bereshit"))
+        os.chdir(work)
+        sources = [{"title": f"bereshit {i}", "fileName": os.path.join("bereshit", f"bereshit {i}.txt")}
+                   for i in range(1, chapters + 1)]
+
+        def documents(embedder, **params):
+            docs = ragPipeline.Documents(sources, embedder, **params)
+            docs.lei()
+            return docs
+
+        embedder = HashEmbedder()
+        docs = documents(embedder, index_kind="exact")
+        total = len(docs.docs)
+        checks.check(embedder.embedded == total and not docs.deleted, "the first lei() embeds every chunk")
+
+        embedder = HashEmbedder()
+        restored = documents(embedder, index_kind="exact")
+        checks.check(embedder.embedded == 0 and restored.version == docs.version, "an unchanged corpus is restored")
+
+        # Rewrites the first verse of chapter 1, only the chunks that contain it change.
+        file_name = os.path.join("bereshit", "bereshit 1.txt")
+        with open(file_name, encoding="utf-8-sig") as f:
+            text = f.read()
+        first = text.index("{א}")
+        end = text.index("{ב}")
+        with open(file_name, "w", encoding="utf-8") as f:
+            f.write(text[:first] + "{א} זרזיר מתוקן נכתב כאן: " + text[end:])
+        # The new verse may also move the chunk boundaries after it, those chunks change too.
+        changed = [doc for doc in embedder.chunker().chunk(sources[0]) if doc not in docs.docs]
+
+        embedder = HashEmbedder()
+        edited = documents(embedder, index_kind="exact")
+        checks.check(embedder.embedded == len(changed), f"the edit re-embeds {len(changed)} chunks, "
+                                                        f"not {embedder.embedded}")
+        checks.check(len(edited.deleted) == len(changed), "the edited chunks are tombstoned")
+        checks.check(edited.docs[:total] == docs.docs, "the other chunks keep their labels")
+
+        def returns_deleted(corpus) -> bool:
+            queries = [corpus.docs[label]["text"] for label in corpus.deleted]
+            return bool(set(np.asarray(corpus.dense(queries)[0]).ravel().tolist()) & set(corpus.deleted))
+
+        checks.check(not returns_deleted(edited), "deleted chunks are not retrieved")
+        best = edited.candidates(["זרזיר מתוקן"])[0][0]
+        checks.check("זרזיר" in edited.docs[best]["text"], "the edited text is found")
+
+        for params, kind, dtype in [({"index_kind": "exact", "storage": "int8"}, "exact", "int8"),
+                                    ({"index_kind": "hnsw"}, "hnsw", None)]:
+            name = f"{kind} {dtype}" if dtype else kind
+            switched = documents(HashEmbedder(), **params)
+            checks.check(switched.index.kind == kind and getattr(switched.index, "dtype", None) == dtype,
+                         f"the restored index is rebuilt as {name}")
+            checks.check(switched.deleted == edited.deleted and not returns_deleted(switched),
+                         f"{name}: deleted chunks stay deleted after the rebuild")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checks the chunker, the indexes and the snapshot refresh offline.")
+    parser.add_argument("--chapters", type=int, default=3)
+    args = parser.parse_args()
+
+    results = Checks()
+    check_chunker(results)
+    check_fusion(results)
+    check_lexical(results)
+    check_exact_index(results)
+    check_documents(results, args.chapters)
+    print(f"{results.passed} checks passed, {len(results.failed)} failed.")
+    if results.failed:
+        raise SystemExit(1)
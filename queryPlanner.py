@@ -0,0 +1,85 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from retrievalCache import normalize_query
+
+
+class QueryPlanner:
+    """-------------------------------------------
+    Turns a user message into search queries, once per message.
+
+    Parameters:
+    generate (Callable): Asks the LLM for the search queries of a message.
+    fan_out (int): How many generate calls run side by side for a message. Their
+    queries are merged, which helps recall when the LLM is sampled with a temperature.
+    max_queries (int): The most queries a message is planned into.
+    cache_size (int): How many planned messages are remembered, least recently used are evicted first.
+    classify (Callable): Plans a message locally, returns None when unsure, then generate is called.
+    ----------------------------------------------"""
+    def __init__(self, generate: Callable[[str], List[str]], fan_out: int = 1, max_queries: int = 4,
+                 cache_size: int = 1024, classify: Optional[Callable[[str], Optional[List[str]]]] = None):
+        self.generate = generate
+        self.classify = classify
+        self.fan_out = max(1, fan_out)
+        self.max_queries = max_queries
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.local = 0
+        self.generated = 0
+
+    """-------------------------------------------
+    Plans the search queries of a message.
+
+    Parameters:
+    message (str): The user's message.
+
+    Returns:
+    List[str]: The distinct search queries, empty if the message needs no retrieval.
+    ----------------------------------------------"""
+    def plan(self, message: str) -> List[str]:
+        key = normalize_query(message)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return list(self.cache[key])
+
+        local = self.classify(message) if self.classify else None
+        if local is not None:
+            generated = [local]
+        elif self.fan_out == 1:
+            generated = [self.generate(message)]
+        else:
+            with ThreadPoolExecutor(max_workers=self.fan_out) as executor:
+                generated = list(executor.map(self.generate, [message] * self.fan_out))
+
+        queries, seen = [], set()
+        for batch in generated:
+            for query in batch:
+                normalized = normalize_query(query)
+                if normalized and normalized not in seen:
+                    seen.add(normalized)
+                    queries.append(query)
+        queries = queries[:self.max_queries]
+
+        with self.lock:
+            if local is not None:
+                self.local += 1
+            else:
+                self.generated += 1
+            self.cache[key] = tuple(queries)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return queries
+
+    # How many messages were planned locally and how many by the LLM, cached messages are not counted.
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            planned = self.local + self.generated
+            return {
+                "local": self.local,
+                "generated": self.generated,
+                "local_rate": self.local / planned if planned else 0.0,
+            }
@@ -0,0 +1,483 @@
+import os
+import uuid
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import corpusSnapshot
+import embedders
+import fusion
+import lexicalIndex
+import queryPlanner
+import rerankGate
+import rerankers
+import responseCache
+import retrievalCache
+import streamRenderer
+import textLoader
+import topicClassifier
+import vectorIndex
+import verseChunker
+from cohereClient import get_client
+
+OFF_TOPIC_MESSAGE = "השאלה לא הייתה קשורה לתנך, סליחה\nשאל שאלה על התנך!"
+
+
+class Documents:
+    """-------------------------------------------
+    The chunked corpus, its embeddings and the vector index over them.
+
+    Every entry point builds its corpus through this class, only the
+    sources, the embedder and the index differ.
+
+    Parameters:
+    sources (List[Dict[str, str]]): The source files, with 'title' and 'fileName' keys.
+    embedder (embedders.Embedder): Embeds the chunks and the search queries.
+    query_cache_path (str): Where to keep the query embedding cache across runs, None to keep it in memory.
+    index_kind (str): "exact", "hnsw", or "auto" to pick by corpus size, see vectorIndex.create_index.
+    recall_target (float): The recall@retrieve_top_k an HNSW index is tuned to, None to build it with
+    the default parameters.
+    storage (str): How the exact index stores the vectors, one of vectorIndex.STORAGE_DTYPES. float16
+    and int8 results are rescored with the full vectors.
+    reranker (rerankers.Reranker): Reorders the candidates, RERANKER (co.rerank by default) if None.
+    ----------------------------------------------"""
+    def __init__(self, sources: List[Dict[str, str]], embedder: embedders.Embedder, query_cache_path: str = None,
+                 index_kind: str = "auto", recall_target: Optional[float] = 0.95, storage: str = "float32",
+                 reranker: Optional[rerankers.Reranker] = None):
+        self.sources = sources
+        self.embedder = embedder
+        self.index_kind = index_kind
+        self.recall_target = recall_target
+        self.storage = storage
+        self.docs = []
+        self.docs_embs = np.empty((0, embedder.dim), dtype=np.float32)
+        self.index = None
+        self.retrieve_top_k = 10
+        self.rerank_top_k = 5
+        self.reranker = reranker or rerankers.from_env()
+        # Skips or shrinks the rerank of queries with a clear best hit, once calibrated with rerankGate.py.
+        self.rerank_gate = rerankGate.RerankGate()
+        self.snapshot_path = None
+        # Repeated search queries skip the embedding round-trip, pass a path to keep the cache across runs.
+        self.query_cache = retrievalCache.QueryEmbeddingCache(path=query_cache_path)
+        self.rerank_cache = retrievalCache.RerankCache()
+        self.version = None
+        self.deleted = []
+        self.files = {}
+        # Exact words and chapter references, which mean-pooled embeddings serve poorly.
+        self.lexical = lexicalIndex.BM25Index()
+        # Chapter references such as פרק-יב are answered by the lexical index alone, off until evaluated.
+        # Without it they still reach the rerank through the BM25 candidates.
+        self.lexical_lookups = False
+
+    # Serves from the on-disk snapshot when there is one, otherwise builds it and saves it.
+    # With incremental=True a restored snapshot is first brought up to date with the source files.
+    def lei(self, incremental=True):
+        # The embeddings are stored unit length, older unnormalized snapshots are not reused.
+        path = corpusSnapshot.snapshot_path(self.embedder.key(), self.embedder.dim, self.sources,
+                                            settings=dict(self.embedder.chunker().settings(), normalized=True))
+        self.snapshot_path = path
+        if self.restore(path):
+            if incremental:
+                self.refresh(path)
+            if self.index_outdated():
+                self.build_index()
+                self.save(path)
+        else:
+            self.load()
+            self.embed()
+            self.build_index()
+            self.files = corpusSnapshot.file_hashes(self.sources)
+            self.save(path)
+        # The lexical index takes a fraction of a second to build, so it is rebuilt instead of saved.
+        self.lexical.build(self.docs, self.deleted)
+        self.rerank_gate = rerankGate.load(path, self.reranker.model)
+
+    # Whether the restored index is not the one index_kind and storage ask for, the snapshot path does not
+    # include them, and "auto" may pick another kind once a refresh changed the corpus size.
+    def index_outdated(self) -> bool:
+        kind = vectorIndex.resolve_kind(self.index_kind, len(self.docs_embs))
+        if self.index.kind != kind:
+            return True
+        return kind == vectorIndex.ExactIndex.kind and self.index.dtype != self.storage
+
+    # Loads the docs, the embeddings and the index from a snapshot, returns False if there is none.
+    def restore(self, path) -> bool:
+        snapshot = corpusSnapshot.load(path, self.embedder.key(), self.embedder.dim)
+        if snapshot is None:
+            return False
+        self.docs, self.docs_embs, self.index, meta = snapshot
+        self.version = meta["version"]
+        self.deleted = meta.get("deleted", [])
+        self.files = meta.get("files", {})
+        print(f"Loaded snapshot with {len(self.docs)} documents.")
+        return True
+
+    # Re-embeds only the chunks of source files whose content changed since the snapshot was saved.
+    def refresh(self, path) -> None:
+        result = corpusSnapshot.refresh(self.docs, self.docs_embs, self.index, self.deleted, self.files,
+                                        self.sources, self.load_source, self.embed_texts)
+        if result is None:
+            return
+        self.docs, self.docs_embs, self.deleted, self.files, stats = result
+        print(f"Re-indexed {stats['embedded']} changed chunks, removed {stats['deleted']}.")
+        self.save(path)
+
+    # Saves the docs, the embeddings and the index so the next launch can skip straight to serving.
+    # The embeddings are then memory-mapped from the snapshot, only the index keeps vectors in memory.
+    def save(self, path) -> None:
+        meta = corpusSnapshot.save(path, self.docs, self.docs_embs, self.index, self.embedder.key(),
+                                   self.embedder.dim, extra={"files": self.files, "deleted": self.deleted})
+        self.version = meta["version"]
+        self.docs_embs = corpusSnapshot.load_embeddings(path)
+
+    # Loads the documents from the sources and chunks them.
+    def load(self) -> None:
+        print("Loading documents...")
+
+        if all(textLoader.is_plain_text(source) for source in self.sources):
+            self.docs.extend(textLoader.load_sources(self.sources, chunk=self.embedder.chunker().chunk))
+            return
+
+        for source in self.sources:
+            self.docs.extend(self.load_source(source))
+
+    # Chunks a single source file, plain text is chunked on verse boundaries.
+    def load_source(self, source: Dict[str, str]) -> List[Dict[str, str]]:
+        if textLoader.is_plain_text(source):
+            return self.embedder.chunker().chunk(source)
+
+        from unstructured.chunking.title import chunk_by_title
+        from unstructured.partition.text import partition_text
+
+        elements = partition_text(filename=source["fileName"], strategy="hi_res", include_page_breaks=True)
+        chunks = chunk_by_title(elements)
+        return [
+            {
+                "title": source["title"],
+                "text": str(chunk),
+                "fileName": source["fileName"],
+            }
+            for chunk in chunks
+        ]
+
+    # Embeds the documents with the embedder.
+    def embed(self) -> None:
+        print("Embedding documents...")
+
+        self.docs_embs = self.embed_texts([item["text"] for item in self.docs])
+
+    # Embeds texts into a contiguous float32 matrix of unit rows. BEREL mean-pooled vectors are
+    # not unit length, and the index ranks by inner product.
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        return vectorIndex.normalize(self.embedder.embed_documents(texts)).reshape(len(texts), self.embedder.dim)
+
+    # Indexes the documents for efficient retrieval. An HNSW index is tuned to the recall target,
+    # or else checked against an exact scan.
+    def build_index(self) -> None:
+        print("Indexing documents...")
+
+        kind = vectorIndex.resolve_kind(self.index_kind, len(self.docs_embs))
+        if kind == vectorIndex.HnswIndex.kind and self.recall_target:
+            self.index, report = vectorIndex.tune_hnsw(self.docs_embs, self.tuning_queries(), k=self.retrieve_top_k,
+                                                       target_recall=self.recall_target)
+            print(f"Tuned HNSW to M={report['M']}, ef_construction={report['ef_construction']}, ef={report['ef']} "
+                  f"with recall@{self.retrieve_top_k} {report['recall']:.3f}, {report['query_ms']:.2f}ms per query.")
+        else:
+            params = {"dtype": self.storage} if kind == vectorIndex.ExactIndex.kind else {}
+            self.index = vectorIndex.create_index(kind, self.embedder.dim, **params)
+            self.index.build(self.docs_embs)
+            if kind != vectorIndex.ExactIndex.kind:
+                recall = vectorIndex.sample_recall(self.index, self.docs_embs, k=self.retrieve_top_k)
+                print(f"Recall@{self.retrieve_top_k} against an exact scan: {recall:.3f}")
+        # The rows of removed chunks are kept in the embeddings, so they are tombstoned again.
+        for label in self.deleted:
+            self.index.mark_deleted(label)
+
+        print(f"Indexing complete with {self.index.get_current_count()} documents ({self.index.kind} index).")
+
+    # The queries the index is tuned on: the cached real search queries if there are enough, else None
+    # to let the tuner sample the chunks.
+    def tuning_queries(self, min_queries: int = 50):
+        queries = self.query_cache.embeddings(self.embedder.key())
+        return queries if queries is not None and len(queries) >= min_queries else None
+
+    """-------------------------------------------
+    Retrieves documents based on the given query.
+
+    Parameters:
+    query (str): The query to retrieve documents for.
+
+    Returns:
+    List[Dict[str, str]]: The retrieved documents, with 'title', 'text' and 'fileName' keys.
+    ----------------------------------------------"""
+    def retrieve(self, query: str) -> List[Dict[str, str]]:
+        return self.retrieve_many([query])[0]
+
+    """-------------------------------------------
+    Retrieves documents for several queries at once.
+
+    With lexical_lookups, chapter references are answered by the lexical
+    index alone. For the other queries the query embeddings that are not cached are fetched in one embed
+    call, all of them go through a single knn_query, the dense and lexical
+    candidates are fused and the reranks run concurrently.
+
+    Parameters:
+    queries (List[str]): The queries to retrieve documents for.
+
+    Returns:
+    List[List[Dict[str, str]]]: The retrieved documents of every query, in
+    query order.
+    ----------------------------------------------"""
+    def retrieve_many(self, queries: List[str]) -> List[List[Dict[str, str]]]:
+        return [[self.record(doc_id) for doc_id in ids] for ids in self.rank_many(queries)]
+
+    # The reranked chunk ids of every query, best first, see retrieve_many.
+    def rank_many(self, queries: List[str]) -> List[List[int]]:
+        ranked = [self.lexical.lookup(query, self.rerank_top_k) if self.lexical_lookups else None
+                  for query in queries]
+        pending = [i for i, ids in enumerate(ranked) if ids is None]
+        for i, ids in zip(pending, self.rank_hybrid([queries[i] for i in pending])):
+            ranked[i] = ids
+        return ranked
+
+    # The reranked chunk ids of every query that needs the dense index, best first. The rerank gate
+    # decides from the dense score margin whether a query skips the rerank or reranks fewer candidates.
+    def rank_hybrid(self, queries: List[str]) -> List[List[int]]:
+        if not queries:
+            return []
+        dense_ids, distances = self.dense(queries)
+        doc_ids = self.fuse(queries, dense_ids)
+        counts = [self.rerank_gate.rerank_count(rerankGate.margin(row), len(ids), self.rerank_top_k)
+                  for row, ids in zip(distances, doc_ids)]
+
+        ranked = [ids[:self.rerank_top_k] if count == 0 else None for ids, count in zip(doc_ids, counts)]
+        pending = [i for i, ids in enumerate(ranked) if ids is None]
+        reranked = self.rerank_many([queries[i] for i in pending], [doc_ids[i][:counts[i]] for i in pending])
+        for i, order in zip(pending, reranked):
+            ranked[i] = [int(doc_ids[i][position]) for position in order]
+        return ranked
+
+    """-------------------------------------------
+    The rerank candidates of queries, from the dense and the lexical index together.
+
+    The dense candidates of every query and its BM25 candidates are fused
+    with reciprocal rank fusion, and the fused top retrieve_top_k are kept.
+
+    Parameters:
+    queries (List[str]): The queries to find candidates for.
+
+    Returns:
+    List[List[int]]: The candidate chunk ids of every query, best fused rank first.
+    ----------------------------------------------"""
+    def candidates(self, queries: List[str]) -> List[List[int]]:
+        if not queries:
+            return []
+        return self.fuse(queries, self.dense(queries)[0])
+
+    # The nearest chunks of every query in the vector index, as (labels, distances), nearest first.
+    def dense(self, queries: List[str]):
+        query_embs = vectorIndex.normalize(
+            self.query_cache.get_or_embed_many(self.embedder.key(), queries, self.embedder.embed_queries))
+        # A small corpus may have fewer live chunks than retrieve_top_k.
+        live = self.index.get_current_count() - len(self.deleted)
+        k = min(self.retrieve_top_k, live)
+        if self.index.quantized():
+            # Oversample the compressed index and rescore the candidates with the full vectors.
+            candidates = self.index.knn_query(query_embs, k=min(k * vectorIndex.RESCORE_OVERSAMPLE, live))[0]
+            return vectorIndex.rescore(self.docs_embs, query_embs, candidates, k)
+        return self.index.knn_query(query_embs, k=k)
+
+    # Fuses the dense candidates of every query with its BM25 candidates, keeps as many as the dense ones.
+    def fuse(self, queries: List[str], dense_ids) -> List[List[int]]:
+        fused = []
+        for query, dense in zip(queries, dense_ids):
+            lexical = [doc_id for doc_id, _ in self.lexical.search(query, len(dense))]
+            fused.append(fusion.reciprocal_rank_fusion([dense, lexical])[:len(dense)])
+        return fused
+
+    # The record of a chunk as it is handed to the chat model.
+    def record(self, doc_id: int) -> Dict[str, str]:
+        return {
+            "title": self.docs[doc_id]["title"],
+            "text": self.docs[doc_id]["text"],
+            "fileName": self.docs[doc_id]["fileName"],
+        }
+
+    # Reranks the candidates of several queries. The orders are cached per query and candidate ids
+    # until the index snapshot changes, the misses go to the reranker together in one call.
+    def rerank_many(self, queries: List[str], doc_ids: List[List[int]]) -> List[List[int]]:
+        orders = [self.rerank_cache.get(self.version, self.reranker.model, query, ids, self.rerank_top_k)
+                  for query, ids in zip(queries, doc_ids)]
+        missing = [i for i, order in enumerate(orders) if order is None]
+        if missing:
+            reranked = self.reranker.rerank_many(
+                [queries[i] for i in missing],
+                [[self.docs[doc_id]["text"] for doc_id in doc_ids[i]] for i in missing],
+                self.rerank_top_k,
+            )
+            for i, order in zip(missing, reranked):
+                self.rerank_cache.put(self.version, self.reranker.model, queries[i], doc_ids[i], self.rerank_top_k,
+                                      order)
+                orders[i] = order
+        return orders
+
+
+class Chatbot:
+    """-------------------------------------------
+    Answers messages with the Cohere chat API, grounded on retrieved documents.
+
+    Parameters:
+    docs (Documents): The indexed corpus.
+    chat_model (str): The Cohere chat model, None for the account default.
+    off_topic_message (str): Printed when a message needs no retrieval.
+    ----------------------------------------------"""
+    def __init__(self, docs: Documents, chat_model: Optional[str] = None, off_topic_message: str = OFF_TOPIC_MESSAGE):
+        self.docs = docs
+        self.conversation_id = str(uuid.uuid4())
+        # Token budget of the documents sent with a single chat call.
+        self.max_document_tokens = 2048
+        self.chat_model = chat_model
+        self.off_topic_message = off_topic_message
+        # Clearly on or off topic messages are planned locally, the rest by the chat model.
+        self.classifier = topicClassifier.load(docs)
+        self.planner = queryPlanner.QueryPlanner(self.generate_queries, classify=self.classifier.classify)
+        # Repeated opening questions are replayed from here instead of planned, retrieved and answered again.
+        # It is shared by every conversation the chatbot serves, see chatEngine.ChatEngine.respond.
+        self.response_cache = responseCache.ResponseCache(threshold=responseCache.load_threshold(docs))
+
+    # The model argument of the co.chat calls, left out when the account default is used.
+    def chat_options(self) -> Dict[str, str]:
+        return {"model": self.chat_model} if self.chat_model else {}
+
+    # The arguments of the streaming co.chat calls, citations interleaved with the text for inline markers.
+    def stream_options(self) -> Dict[str, str]:
+        return dict(self.chat_options(), citation_quality=streamRenderer.CITATION_QUALITY)
+
+    # The embedding a message is looked up by in the response cache, from the corpus embedder.
+    def message_embedding(self, message: str) -> np.ndarray:
+        return self.docs.query_cache.get_or_embed_many(self.docs.embedder.key(), [message],
+                                                       self.docs.embedder.embed_queries)[0]
+
+    # Looks a message up in the response cache, returns (embedding, answer), the answer is None on a miss.
+    # The message is only embedded when the cache has a calibrated similarity threshold.
+    def cached_answer(self, message: str):
+        embedding = self.message_embedding(message) if self.response_cache.threshold is not None else None
+        return embedding, self.response_cache.get(self.docs.version, message, embedding)
+
+    # Keeps a finished answer in the response cache, unless it was not grounded on any document.
+    def store_answer(self, message: str, embedding, queries: List[str], documents: List[Dict[str, str]],
+                     response) -> None:
+        if getattr(response, "documents", None):
+            self.response_cache.put(self.docs.version, message, embedding,
+                                    responseCache.CachedAnswer.from_response(queries, documents, response))
+
+    # Asks the chat model for the search queries of a message, called by the planner.
+    def generate_queries(self, message: str) -> List[str]:
+        response = get_client().chat(message=message, search_queries_only=True, **self.chat_options())
+        return [query["text"] for query in response.search_queries or []]
+
+    """------------------------------------------
+    Generates a response to the user's message.
+
+    Parameters:
+    message (str): The user's message.
+
+    Yields:
+    Event: The co.chat stream events, then the finished response.
+    -------------------------------------------"""
+    def generate_response(self, message: str):
+        # Generate search queries (if any), repeated messages come from the planner's cache
+        queries = self.planner.plan(message)
+
+        # If there is no search query, the message is not about the corpus
+        if not queries:
+            print(self.off_topic_message)
+            return
+
+        print("Retrieving information...")
+        documents = self.retrieve_queries(queries)
+        response = get_client().chat(
+            message=message,
+            documents=documents,
+            conversation_id=self.conversation_id,
+            stream=True,
+            **self.stream_options(),
+        )
+        for event in response:
+            yield event
+        if not response.documents:
+            print(self.off_topic_message)
+            return
+        yield response
+
+    """----------------------------------------------------------
+    Retrieves documents for all queries together.
+
+    The rankings of the queries are fused with reciprocal rank fusion, so a
+    chunk found by several queries is sent to the chat model once, and the
+    fused set is capped to max_document_tokens.
+
+    Parameters:
+    queries (List[str]): The search queries.
+
+    Returns:
+    List[Dict[str, str]]: The retrieved documents, best first.
+    ----------------------------------------------------------"""
+    def retrieve_queries(self, queries: List[str]) -> List[Dict[str, str]]:
+        doc_ids = fusion.reciprocal_rank_fusion(self.docs.rank_many(queries))
+        doc_ids = fusion.cap_to_budget(
+            doc_ids,
+            lambda doc_id: verseChunker.estimate_tokens(self.docs.docs[doc_id]["text"]),
+            self.max_document_tokens,
+        )
+        return [self.docs.record(doc_id) for doc_id in doc_ids]
+
+
+class App:
+    def __init__(self, chatbot: Chatbot):
+        self.chatbot = chatbot
+
+    # Runs the chatbot application.
+    def run(self):
+        renderer = streamRenderer.StreamRenderer()
+        while True:
+            # Gets the user message
+            message = input("User: ")
+
+            # Typing "quit" ends the conversation
+            if message.lower() == "quit":
+                print("Ending chat.")
+                break
+
+            # Tokens are printed as they arrive, the time to first token counts from here
+            renderer.start()
+            response = self.chatbot.generate_response(message)
+
+            # Print the chatbot response
+            print("Chatbot:")
+            for event in response:
+                renderer.render(event)
+
+            print(f"\n{'-' * 100}\n")
+
+
+"""-------------------------------------------
+Builds the index (or loads its snapshot) and the chatbot over it.
+
+Parameters:
+sources (List[Dict[str, str]]): The source files.
+embedder (embedders.Embedder): The embedding model.
+chat_model (str): The Cohere chat model, None for the account default.
+index_kind (str): "exact", "hnsw", or "auto" to pick by corpus size.
+storage (str): How the exact index stores the vectors, one of vectorIndex.STORAGE_DTYPES.
+
+Returns:
+Chatbot: The chatbot, ready to answer.
+----------------------------------------------"""
+def build_chatbot(sources: List[Dict[str, str]], embedder: embedders.Embedder, chat_model: Optional[str] = None,
+                  index_kind: str = "auto", storage: str = "float32") -> Chatbot:
+    documents = Documents(sources, embedder, index_kind=index_kind, storage=storage,
+                          query_cache_path=os.path.join(corpusSnapshot.SNAPSHOT_ROOT, "query_cache.json"))
+    documents.lei()
+    return Chatbot(documents, chat_model)
@@ -0,0 +1,178 @@
+import argparse
+import importlib
+import json
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Kept in the snapshot directory, next to the embeddings the margins are measured on.
+GATE_FILE = "rerank_gate.json"
+# A threshold is only trusted when at least this many calibration queries are above it.
+MIN_CALIBRATION_QUERIES = 5
+
+
+# How clearly the best dense hit beats the runner-up: the gap between their cosine similarities.
+# Distances are 1 - inner product, so the gap is the second distance minus the first.
+def margin(distances) -> float:
+    if len(distances) < 2:
+        return float("inf")
+    return float(distances[1]) - float(distances[0])
+
+
+class RerankGate:
+    """-------------------------------------------
+    Decides per query how much of the rerank is needed, from the dense score margin.
+
+    A query whose best dense hit is far ahead of the next one skips the
+    rerank and keeps the fused order. A smaller margin reranks only the
+    first shrink_top_k candidates, and the rest get the full rerank. A
+    gate without thresholds reranks everything, like before.
+
+    Parameters:
+    skip_margin (float): The margin from which the rerank is skipped, None to never skip.
+    shrink_margin (float): The margin from which only shrink_top_k candidates are reranked, None to never shrink.
+    shrink_top_k (int): How many candidates a shrunk rerank sees, rerank_top_k if None.
+    ----------------------------------------------"""
+    def __init__(self, skip_margin: Optional[float] = None, shrink_margin: Optional[float] = None,
+                 shrink_top_k: Optional[int] = None):
+        self.skip_margin = skip_margin
+        self.shrink_margin = shrink_margin
+        self.shrink_top_k = shrink_top_k
+
+    def enabled(self) -> bool:
+        return self.skip_margin is not None or self.shrink_margin is not None
+
+    # How many of the candidates to rerank, 0 to skip the rerank.
+    def rerank_count(self, query_margin: float, candidates: int, rerank_top_k: int) -> int:
+        if self.skip_margin is not None and query_margin >= self.skip_margin:
+            return 0
+        if self.shrink_margin is not None and query_margin >= self.shrink_margin:
+            return min(candidates, max(self.shrink_top_k or rerank_top_k, rerank_top_k))
+        return candidates
+
+    def to_dict(self) -> Dict:
+        return {"skip_margin": self.skip_margin, "shrink_margin": self.shrink_margin,
+                "shrink_top_k": self.shrink_top_k}
+
+
+# The calibrated gate of a reranker from a snapshot directory, a gate that always reranks if there is none.
+def load(path: str, reranker_model: str) -> RerankGate:
+    gate_file = os.path.join(path, GATE_FILE)
+    if not os.path.exists(gate_file):
+        return RerankGate()
+    with open(gate_file, encoding="utf-8") as f:
+        return RerankGate(**json.load(f).get(reranker_model, {}))
+
+
+# Stores the gate of a reranker in a snapshot directory, next to the gates of other rerankers.
+def save(path: str, reranker_model: str, gate: RerankGate) -> None:
+    gate_file = os.path.join(path, GATE_FILE)
+    gates = {}
+    if os.path.exists(gate_file):
+        with open(gate_file, encoding="utf-8") as f:
+            gates = json.load(f)
+    gates[reranker_model] = gate.to_dict()
+    with open(gate_file, "w", encoding="utf-8") as f:
+        json.dump(gates, f, indent=2)
+
+
+"""-------------------------------------------
+The lowest margin above which a cheaper ranking agrees often enough with the full rerank.
+
+Parameters:
+margins (List[float]): The dense margin of every calibration query.
+agrees (List[bool]): Whether the cheaper ranking of the query has the same top hit as the full rerank.
+target (float): The agreement the queries above the threshold must reach.
+min_queries (int): The fewest queries a threshold may be based on.
+
+Returns:
+float: The threshold, or None if no margin reaches the target.
+----------------------------------------------"""
+def threshold(margins: List[float], agrees: List[bool], target: float,
+              min_queries: int = MIN_CALIBRATION_QUERIES) -> Optional[float]:
+    order = np.argsort(-np.asarray(margins, dtype=np.float64), kind="stable")
+    sorted_margins = np.asarray(margins, dtype=np.float64)[order]
+    agreement = np.cumsum(np.asarray(agrees, dtype=np.float64)[order]) / np.arange(1, len(order) + 1)
+
+    best = None
+    for i in range(len(order)):
+        # Queries with the same margin are all on the same side of the threshold.
+        if i + 1 < len(order) and sorted_margins[i + 1] == sorted_margins[i]:
+            continue
+        if i + 1 >= min_queries and agreement[i] >= target:
+            best = float(sorted_margins[i])
+    return best
+
+
+"""-------------------------------------------
+Calibrates the rerank gate of a corpus on sample queries.
+
+Every query is ranked three ways: the full rerank of all the candidates,
+the fused order without a rerank, and a rerank of only the first
+shrink_top_k candidates. The thresholds are the lowest margins from which
+the two cheaper rankings keep the top hit of the full rerank for the
+target share of the queries.
+
+Parameters:
+corpus (ragPipeline.Documents): A corpus after lei().
+queries (List[str]): The calibration queries, real search queries if possible.
+target (float): The top-1 agreement with the full rerank the gate must keep.
+shrink_top_k (int): How many candidates a shrunk rerank sees, rerank_top_k if None.
+
+Returns:
+Tuple: (gate, report), the report has the thresholds and the share of the
+queries that skip or shrink the rerank with them.
+----------------------------------------------"""
+def calibrate(corpus, queries: List[str], target: float = 0.95, shrink_top_k: Optional[int] = None):
+    shrink_top_k = max(shrink_top_k or corpus.rerank_top_k, corpus.rerank_top_k)
+    dense_ids, distances = corpus.dense(queries)
+    doc_ids = corpus.fuse(queries, dense_ids)
+    margins = [margin(row) for row in distances]
+
+    full = corpus.reranker.rerank_many(queries, [[corpus.docs[i]["text"] for i in ids] for ids in doc_ids],
+                                       corpus.rerank_top_k)
+    full_top = [int(ids[order[0]]) if order else None for ids, order in zip(doc_ids, full)]
+    shrunk = corpus.reranker.rerank_many(
+        queries, [[corpus.docs[i]["text"] for i in ids[:shrink_top_k]] for ids in doc_ids], corpus.rerank_top_k)
+
+    skip_agrees = [bool(ids) and int(ids[0]) == top for ids, top in zip(doc_ids, full_top)]
+    shrink_agrees = [bool(order) and int(ids[order[0]]) == top for ids, order, top in zip(doc_ids, shrunk, full_top)]
+    gate = RerankGate(threshold(margins, skip_agrees, target), threshold(margins, shrink_agrees, target),
+                      shrink_top_k)
+
+    counts = [gate.rerank_count(m, len(ids), corpus.rerank_top_k) for m, ids in zip(margins, doc_ids)]
+    report = dict(gate.to_dict(),
+                  queries=len(queries),
+                  skipped=float(np.mean([count == 0 for count in counts])),
+                  shrunk=float(np.mean([0 < count < len(ids) for count, ids in zip(counts, doc_ids)])),
+                  agreement=float(np.mean([
+                      agree_skip if count == 0 else agree_shrink if count < len(ids) else True
+                      for count, ids, agree_skip, agree_shrink in zip(counts, doc_ids, skip_agrees, shrink_agrees)
+                  ])))
+    return gate, report
+
+
+if __name__ == "__main__":
+    import rerankers
+    import server
+
+    parser = argparse.ArgumentParser(description="Calibrates the rerank gate of an app on sample queries.")
+    parser.add_argument("--app", default="cohere", choices=sorted(server.APPS))
+    parser.add_argument("--queries", help="A file with one query per line.")
+    parser.add_argument("--target", type=float, default=0.95, help="The top-1 agreement with the full rerank.")
+    parser.add_argument("--shrink-top-k", type=int, help="How many candidates a shrunk rerank sees.")
+    args = parser.parse_args()
+
+    if args.queries:
+        with open(args.queries, encoding="utf-8") as f:
+            sample = [line.strip() for line in f if line.strip()]
+    else:
+        sample = rerankers.SAMPLE_QUERIES
+
+    corpus = importlib.import_module(server.APPS[args.app]).build_chatbot().docs
+    gate, report = calibrate(corpus, sample, args.target, args.shrink_top_k)
+    save(corpus.snapshot_path, corpus.reranker.model, gate)
+    print(f"skip_margin={report['skip_margin']}, shrink_margin={report['shrink_margin']}: "
+          f"{report['skipped']:.0%} of {report['queries']} queries skip the rerank, {report['shrunk']:.0%} shrink it, "
+          f"top-1 agreement {report['agreement']:.2f}. Saved to {os.path.join(corpus.snapshot_path, GATE_FILE)}")
@@ -0,0 +1,198 @@
+import argparse
+import functools
+import importlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import numpy as np
+
+import berelEncoder
+from cohereClient import get_client
+
+# A small multilingual cross-encoder (mMiniLM fine-tuned on mMARCO) that runs on CPU.
+DEFAULT_CROSS_ENCODER = "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"
+
+
+class Reranker:
+    """-------------------------------------------
+    The interface of a reranker.
+
+    Attributes:
+    model (str): The model name, part of the rerank cache keys.
+    ----------------------------------------------"""
+    model = None
+
+    # Reorders the candidate texts of every query, returns their positions best first, at most top_n per query.
+    # The queries of one message go through one call.
+    def rerank_many(self, queries: List[str], documents: List[List[str]], top_n: int) -> List[List[int]]:
+        raise NotImplementedError
+
+
+class CohereReranker(Reranker):
+    """-------------------------------------------
+    Reranks with the Cohere API, the queries of a message are sent side by side.
+
+    Parameters:
+    model (str): The Cohere rerank model.
+    max_workers (int): How many rerank requests may run at the same time.
+    ----------------------------------------------"""
+    def __init__(self, model: str = "rerank-multilingual-v3.0", max_workers: int = 8):
+        self.model = model
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def rerank_one(self, query: str, documents: List[str], top_n: int) -> List[int]:
+        return [result.index for result in get_client().rerank(
+            query=query,
+            documents=documents,
+            top_n=top_n,
+            model=self.model,
+        )]
+
+    def rerank_many(self, queries: List[str], documents: List[List[str]], top_n: int) -> List[List[int]]:
+        return list(self.executor.map(self.rerank_one, queries, documents, [top_n] * len(queries)))
+
+
+# The shared cross-encoder and its tokenizer, loaded on first use.
+@functools.lru_cache(maxsize=None)
+def load_cross_encoder(model_name: str):
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModelForSequenceClassification.from_pretrained(model_name)
+    model.eval()
+    return tokenizer, model
+
+
+class CrossEncoderReranker(Reranker):
+    """-------------------------------------------
+    Reranks locally on CPU with a cross-encoder.
+
+    Every (query, candidate) pair of all the queries is scored in the same
+    length-bucketed batches the BEREL encoder uses, so a message with four
+    queries of ten candidates is a few forward passes, with no network.
+
+    Parameters:
+    model (str): The Hugging Face cross-encoder.
+    max_length (int): Pairs are truncated to this many tokens, the candidate side first.
+    max_batch_tokens (int): The padded size limit of a batch.
+    ----------------------------------------------"""
+    def __init__(self, model: str = DEFAULT_CROSS_ENCODER, max_length: int = 512,
+                 max_batch_tokens: int = berelEncoder.MAX_BATCH_TOKENS):
+        self.model = model
+        self.max_length = max_length
+        self.max_batch_tokens = max_batch_tokens
+
+    # The relevance score of every (query, document) pair.
+    def score(self, queries: List[str], documents: List[str]) -> np.ndarray:
+        import torch
+
+        tokenizer, model = load_cross_encoder(self.model)
+        scores = np.empty(len(queries), dtype=np.float32)
+        if not queries:
+            return scores
+        encoded = tokenizer(list(queries), list(documents), truncation="only_second", max_length=self.max_length)
+        lengths = [len(ids) for ids in encoded["input_ids"]]
+        for batch in berelEncoder.length_batches(lengths, self.max_batch_tokens):
+            features = tokenizer.pad({key: [encoded[key][i] for i in batch] for key in encoded.keys()},
+                                     return_tensors="pt")
+            with torch.inference_mode():
+                logits = model(**features).logits.float()
+            # One logit is the relevance itself, two are (irrelevant, relevant).
+            relevance = logits[:, 0] if logits.shape[1] == 1 else logits[:, -1] - logits[:, 0]
+            scores[batch] = relevance.numpy()
+        return scores
+
+    def rerank_many(self, queries: List[str], documents: List[List[str]], top_n: int) -> List[List[int]]:
+        pair_queries = [query for query, texts in zip(queries, documents) for _ in texts]
+        pair_documents = [text for texts in documents for text in texts]
+        scores = self.score(pair_queries, pair_documents)
+
+        orders, start = [], 0
+        for texts in documents:
+            query_scores = scores[start:start + len(texts)]
+            orders.append([int(i) for i in np.argsort(-query_scores, kind="stable")[:top_n]])
+            start += len(texts)
+        return orders
+
+
+RERANKERS = {"cohere": CohereReranker, "cross-encoder": CrossEncoderReranker}
+
+
+# The reranker named by RERANKER, the Cohere API if it is not set.
+def from_env() -> Reranker:
+    name = os.getenv("RERANKER", "cohere")
+    if name not in RERANKERS:
+        raise ValueError(f"Unknown reranker '{name}', expected one of {', '.join(RERANKERS)}.")
+    return RERANKERS[name]()
+
+
+"""-------------------------------------------
+Compares a reranker with a reference reranker on the same candidates.
+
+Parameters:
+reference (Reranker): The reranker taken as ground truth, usually Cohere.
+candidate (Reranker): The reranker to check.
+queries (List[str]): The search queries.
+documents (List[List[str]]): The candidate texts of every query.
+top_n (int): How many reranked candidates are kept.
+
+Returns:
+Dict: The share of queries with the same top candidate, the mean overlap
+of the top_n sets, and the seconds each reranker took for all queries.
+----------------------------------------------"""
+def compare(reference: Reranker, candidate: Reranker, queries: List[str], documents: List[List[str]],
+            top_n: int = 5) -> dict:
+    start = time.perf_counter()
+    expected = reference.rerank_many(queries, documents, top_n)
+    reference_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = candidate.rerank_many(queries, documents, top_n)
+    candidate_seconds = time.perf_counter() - start
+
+    return {
+        "top1_agreement": float(np.mean([a[:1] == b[:1] for a, b in zip(expected, actual)])),
+        "overlap": float(np.mean([len(set(a) & set(b)) / max(len(a), 1) for a, b in zip(expected, actual)])),
+        "reference_seconds": reference_seconds,
+        "candidate_seconds": candidate_seconds,
+    }
+
+
+# Questions about Bereshit for the comparison, used when no query file is given.
+SAMPLE_QUERIES = [
+    "מי ברא את השמים והארץ",
+    "מה אכל אדם בגן עדן",
+    "למה הרג קין את הבל",
+    "כמה ימים ירד המבול",
+    "מה הבטיח אלהים לאברהם",
+    "מי היתה אשתו של יצחק",
+    "איך קנה יעקב את הבכורה",
+    "מה חלם יוסף",
+    "למה ירדו בני יעקב למצרים",
+    "מה ברך יעקב את בניו לפני מותו",
+]
+
+
+if __name__ == "__main__":
+    import server
+
+    parser = argparse.ArgumentParser(description="Compares a local reranker with co.rerank on real candidates.")
+    parser.add_argument("--app", default="cohere", choices=sorted(server.APPS))
+    parser.add_argument("--model", default=DEFAULT_CROSS_ENCODER)
+    parser.add_argument("--queries", help="A file with one query per line.")
+    args = parser.parse_args()
+
+    if args.queries:
+        with open(args.queries, encoding="utf-8") as f:
+            sample = [line.strip() for line in f if line.strip()]
+    else:
+        sample = SAMPLE_QUERIES
+
+    corpus = importlib.import_module(server.APPS[args.app]).build_chatbot().docs
+    candidates = [[corpus.docs[doc_id]["text"] for doc_id in ids] for ids in corpus.candidates(sample)]
+    result = compare(CohereReranker(), CrossEncoderReranker(args.model), sample, candidates, corpus.rerank_top_k)
+    print(f"{args.model}: top-1 agreement {result['top1_agreement']:.2f}, top-{corpus.rerank_top_k} overlap "
+          f"{result['overlap']:.2f}, {result['reference_seconds']:.2f}s co.rerank vs "
+          f"{result['candidate_seconds']:.2f}s local on {len(sample)} queries")
@@ -0,0 +1,270 @@
+import argparse
+import importlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import rerankGate
+from retrievalCache import normalize_query
+from streamRenderer import field
+
+# Kept in the snapshot directory, the similarities depend on the embedder of the snapshot.
+CACHE_FILE = "response_cache.json"
+
+
+# The replayed events are named like the co.chat stream events, so StreamRenderer and the
+# server handle a replayed answer exactly like a live one.
+class StreamTextGeneration:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class StreamCitationGeneration:
+    def __init__(self, citations: List[dict]):
+        self.citations = citations
+
+
+class StreamingChat:
+    def __init__(self, text: str, conversation_id: str, citations: List[dict], documents: List[dict]):
+        self.text = text
+        self.conversation_id = conversation_id
+        self.citations = citations
+        self.documents = documents
+
+
+class CachedAnswer:
+    """-------------------------------------------
+    A finished answer as the response cache keeps it.
+
+    Only the content of the answer is kept, not the co.chat response, which
+    belongs to the conversation of the user who asked first.
+
+    Parameters:
+    queries (List[str]): The search queries of the message.
+    documents (List[Dict[str, str]]): The retrieved documents.
+    text (str): The answer.
+    citations (List[dict]): The citations of the answer.
+    cited_documents (List[dict]): The documents of the co.chat response.
+    ----------------------------------------------"""
+    def __init__(self, queries: List[str], documents: List[Dict[str, str]], text: str, citations: List[dict],
+                 cited_documents: List[dict]):
+        self.queries = queries
+        self.documents = documents
+        self.text = text
+        self.citations = citations
+        self.cited_documents = cited_documents
+
+    @classmethod
+    def from_response(cls, queries: List[str], documents: List[Dict[str, str]], response) -> "CachedAnswer":
+        citations = [{name: field(citation, name) for name in ("start", "end", "text", "document_ids")}
+                     for citation in getattr(response, "citations", None) or []]
+        cited_documents = [dict(document) if isinstance(document, dict) else vars(document)
+                           for document in getattr(response, "documents", None) or []]
+        return cls(list(queries), documents, response.text, citations, cited_documents)
+
+    # The answer as a stream in the given conversation. The text is cut at the end of every
+    # citation, so the citations arrive right after the text they cite, as they do live.
+    def events(self, conversation_id: str) -> List[object]:
+        events, written = [], 0
+        for citation in sorted(self.citations, key=lambda citation: citation["end"] or 0):
+            end = citation["end"] or 0
+            if end > written:
+                events.append(StreamTextGeneration(self.text[written:end]))
+                written = end
+            events.append(StreamCitationGeneration([citation]))
+        if written < len(self.text):
+            events.append(StreamTextGeneration(self.text[written:]))
+        events.append(StreamingChat(self.text, conversation_id, self.citations, self.cited_documents))
+        return events
+
+
+class ResponseCache:
+    """-------------------------------------------
+    A bounded LRU cache of finished answers, looked up by message similarity.
+
+    A message with the same normalized text as a cached one always gets its
+    answer. With a threshold, so does a message whose embedding is at least
+    that cosine-similar to a cached one, so rephrasings of a common question
+    skip the planning, the retrieval and both co.chat calls. Like
+    RerankCache, the cache is tied to one index snapshot version and is
+    emptied when it is used with another one.
+
+    Parameters:
+    threshold (float): The lowest cosine similarity that counts as the same question, None to match
+    the normalized text only. Calibrate it per embedder with calibrate().
+    max_size (int): The number of answers kept, the least recently used are evicted first.
+    ttl (float): Seconds an answer stays valid, None to keep answers until evicted.
+    ----------------------------------------------"""
+    def __init__(self, threshold: Optional[float] = None, max_size: int = 1024, ttl: Optional[float] = None):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.version = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # The cached message embeddings stacked for the similarity scan, rebuilt after entries change.
+        self.keys = []
+        self.matrix = None
+
+    @staticmethod
+    def unit(embedding) -> np.ndarray:
+        embedding = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+
+    # Empties the cache when the index version changes, called with the lock held.
+    def check_version(self, version: str) -> None:
+        if version != self.version:
+            self.entries.clear()
+            self.matrix = None
+            self.version = version
+
+    # The key of the cached message most similar to the embedding, if it is similar enough. Called with the lock held.
+    def nearest(self, embedding) -> Optional[str]:
+        if self.threshold is None or embedding is None or not self.entries:
+            return None
+        if self.matrix is None:
+            self.keys = list(self.entries)
+            self.matrix = np.vstack([self.entries[key][1] for key in self.keys])
+        similarities = self.matrix @ self.unit(embedding)
+        best = int(np.argmax(similarities))
+        return self.keys[best] if similarities[best] >= self.threshold else None
+
+    # Returns the cached answer of the same or the most similar message, or None on a miss.
+    def get(self, version: str, message: str, embedding=None) -> Optional[CachedAnswer]:
+        with self.lock:
+            self.check_version(version)
+            key = normalize_query(message)
+            if key not in self.entries:
+                key = self.nearest(embedding)
+            entry = self.entries.get(key) if key is not None else None
+            if entry is not None and self.ttl is not None and time.time() - entry[0] > self.ttl:
+                del self.entries[key]
+                self.matrix = None
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    # Keeps an answer, the embedding is only needed when the cache matches by similarity.
+    def put(self, version: str, message: str, embedding, answer: CachedAnswer) -> None:
+        with self.lock:
+            if version != self.version:
+                return
+            key = normalize_query(message)
+            self.entries[key] = (time.time(), None if embedding is None else self.unit(embedding), answer)
+            self.entries.move_to_end(key)
+            self.matrix = None
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self.entries),
+                "evictions": self.evictions,
+                "threshold": self.threshold,
+            }
+
+
+# The similarity threshold calibrated for the snapshot of a corpus, None if it was not calibrated.
+def load_threshold(docs) -> Optional[float]:
+    if docs.snapshot_path is None:
+        return None
+    cache_file = os.path.join(docs.snapshot_path, CACHE_FILE)
+    if not os.path.exists(cache_file):
+        return None
+    with open(cache_file, encoding="utf-8") as f:
+        return json.load(f).get("threshold")
+
+
+def save_threshold(docs, threshold: Optional[float]) -> None:
+    with open(os.path.join(docs.snapshot_path, CACHE_FILE), "w", encoding="utf-8") as f:
+        json.dump({"threshold": threshold}, f, indent=2)
+
+
+"""-------------------------------------------
+Calibrates the similarity threshold of the response cache for the embedder of a corpus.
+
+Every pair of messages in the same group asks the same question, and every
+pair from different groups asks different ones. The threshold is the
+lowest similarity from which the given share of the pairs are the same
+question. Mean-pooled BEREL vectors are much closer to each other than
+Cohere's, so each embedder needs its own threshold.
+
+Parameters:
+docs (ragPipeline.Documents): A corpus after lei(), its embedder embeds the messages.
+groups (List[List[str]]): Rephrasings of the same question, one list per question.
+precision (float): The share of the pairs above the threshold that must be the same question.
+
+Returns:
+Tuple: (threshold, report), the threshold is None if no similarity reaches the precision.
+----------------------------------------------"""
+def calibrate(docs, groups: List[List[str]], precision: float = 0.99) -> Tuple[Optional[float], dict]:
+    messages = [message for group in groups for message in group]
+    labels = [i for i, group in enumerate(groups) for _ in group]
+    embeddings = np.vstack([ResponseCache.unit(row) for row in docs.query_cache.get_or_embed_many(
+        docs.embedder.key(), messages, docs.embedder.embed_queries)])
+    similarities = embeddings @ embeddings.T
+
+    pairs, same = [], []
+    for i in range(len(messages)):
+        for j in range(i + 1, len(messages)):
+            pairs.append(float(similarities[i, j]))
+            same.append(labels[i] == labels[j])
+    threshold = rerankGate.threshold(pairs, same, precision)
+    hits = [similarity >= threshold for similarity, is_same in zip(pairs, same) if is_same] if threshold is not None else []
+    return threshold, {"threshold": threshold, "pairs": len(pairs),
+                       "recall": sum(hits) / max(sum(same), 1)}
+
+
+# Rephrasings of common Bereshit questions, used when no file is given.
+SAMPLE_GROUPS = [
+    ["מי ברא את השמים והארץ", "מי ברא את העולם", "מי יצר את השמים ואת הארץ"],
+    ["למה הרג קין את הבל", "מדוע קין רצח את הבל", "מה הסיבה שקין הרג את אחיו"],
+    ["כמה ימים ירד המבול", "כמה זמן נמשך המבול", "כמה ימים ירד גשם במבול"],
+    ["מי היתה אשתו של יצחק", "עם מי התחתן יצחק", "מה שם אשת יצחק"],
+    ["איך קנה יעקב את הבכורה", "איך יעקב השיג את הבכורה מעשו", "באיזו דרך קיבל יעקב את הבכורה"],
+    ["מה חלם יוסף", "מה היו החלומות של יוסף", "על מה חלם יוסף"],
+    ["למה ירדו בני יעקב למצרים", "מדוע ירדו האחים למצרים", "מה הביא את בני יעקב לרדת מצרימה"],
+    ["מה אכל אדם בגן עדן", "ממה אכל אדם בגן עדן", "איזה פרי אכל אדם בגן"],
+]
+
+
+if __name__ == "__main__":
+    import server
+
+    parser = argparse.ArgumentParser(description="Calibrates the response cache similarity threshold of an app.")
+    parser.add_argument("--app", default="cohere", choices=sorted(server.APPS))
+    parser.add_argument("--groups", help="A file with one question per line, rephrasings of it on the same line "
+                                         "separated by '|'.")
+    parser.add_argument("--precision", type=float, default=0.99)
+    args = parser.parse_args()
+
+    if args.groups:
+        with open(args.groups, encoding="utf-8") as f:
+            sample = [[part.strip() for part in line.split("|") if part.strip()] for line in f if line.strip()]
+    else:
+        sample = SAMPLE_GROUPS
+
+    corpus = importlib.import_module(server.APPS[args.app]).build_chatbot().docs
+    calibrated, report = calibrate(corpus, sample, args.precision)
+    save_threshold(corpus, calibrated)
+    print(f"threshold={report['threshold']}: {report['recall']:.0%} of the rephrasings would be answered from the "
+          f"cache, on {report['pairs']} pairs. Saved to {os.path.join(corpus.snapshot_path, CACHE_FILE)}")
@@ -0,0 +1,207 @@
+import atexit
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+import uuid
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+
+# Normalizes a query so that trivially different spellings share a cache entry.
+def normalize_query(query: str) -> str:
+    query = unicodedata.normalize("NFC", query).casefold()
+    query = re.sub(r"\s+", " ", query)
+    return query.strip(" ?!.,:;\"'")
+
+
+class QueryEmbeddingCache:
+    """-------------------------------------------
+    A bounded LRU cache of query embeddings with an optional time to live.
+
+    Entries are keyed on the embedding model and the normalized query text.
+
+    Parameters:
+    max_size (int): The number of entries kept, the least recently used are evicted first.
+    ttl (float): Seconds an entry stays valid, None to keep entries until evicted.
+    path (str): A JSON file to load the cache keys from and save them to on exit, the embeddings go in an
+    .npz file next to it. None to keep the cache in memory.
+    ----------------------------------------------"""
+    def __init__(self, max_size: int = 4096, ttl: Optional[float] = None, path: Optional[str] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if path:
+            self.load()
+            atexit.register(self.save)
+
+    # Returns the cached embedding, or None on a miss.
+    def get(self, model: str, query: str) -> Optional[np.ndarray]:
+        key = (model, normalize_query(query))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and time.time() - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, model: str, query: str, embedding) -> None:
+        key = (model, normalize_query(query))
+        with self.lock:
+            self.entries[key] = (time.time(), np.asarray(embedding, dtype=np.float32))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    # Returns the cached embeddings of the queries, the misses are embedded together with one embed_many(queries) call.
+    def get_or_embed_many(self, model: str, queries: List[str],
+                          embed_many: Callable[[List[str]], object]) -> np.ndarray:
+        embeddings = [self.get(model, query) for query in queries]
+        missing = list(dict.fromkeys(query for query, embedding in zip(queries, embeddings) if embedding is None))
+        if missing:
+            embedded = dict(zip(missing, np.asarray(embed_many(missing), dtype=np.float32)))
+            for query, embedding in embedded.items():
+                self.put(model, query, embedding)
+            embeddings = [embedded[query] if embedding is None else embedding
+                          for query, embedding in zip(queries, embeddings)]
+        return np.vstack(embeddings)
+
+    # The cached query embeddings of a model, most recent last. Real queries make good index tuning samples.
+    def embeddings(self, model: str) -> Optional[np.ndarray]:
+        with self.lock:
+            rows = [embedding for (entry_model, _), (_, embedding) in self.entries.items() if entry_model == model]
+        return np.vstack(rows) if rows else None
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self.entries),
+            }
+
+    # The matrix file next to the JSON key list, one array per model since their dimensions differ.
+    def embeddings_path(self) -> str:
+        return os.path.splitext(self.path)[0] + ".npz"
+
+    # Saves the keys as JSON and the embeddings as arrays, writing floats as JSON text is far too slow.
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self.lock:
+            items = list(self.entries.items())
+        models, rows, entries = [], {}, []
+        for (model, query), (created, embedding) in items:
+            if model not in rows:
+                models.append(model)
+                rows[model] = []
+            entries.append([models.index(model), query, created])
+            rows[model].append(embedding)
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Both files carry the same stamp, so a key list is never matched with the arrays of another save.
+        stamp = uuid.uuid4().hex
+        tmp_embeddings = self.embeddings_path() + ".tmp.npz"
+        np.savez(tmp_embeddings, stamp=np.array(stamp),
+                 **{f"m{i}": np.vstack(rows[model]) for i, model in enumerate(models)})
+        os.replace(tmp_embeddings, self.embeddings_path())
+        tmp_file = self.path + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"stamp": stamp, "models": models, "entries": entries}, f, ensure_ascii=False)
+        os.replace(tmp_file, self.path)
+
+    def load(self) -> None:
+        if not os.path.exists(self.path) or not os.path.exists(self.embeddings_path()):
+            return
+        with open(self.path, encoding="utf-8") as f:
+            keys = json.load(f)
+        if not isinstance(keys, dict):
+            # The embeddings of older caches were inlined in the JSON, they are dropped and re-embedded.
+            return
+        now = time.time()
+        with np.load(self.embeddings_path()) as arrays:
+            if str(arrays["stamp"]) != keys.get("stamp"):
+                return
+            matrices = [arrays[f"m{i}"] for i in range(len(keys["models"]))]
+        positions = [0] * len(matrices)
+        loaded = []
+        for model_index, query, created in keys["entries"]:
+            embedding = matrices[model_index][positions[model_index]]
+            positions[model_index] += 1
+            if self.ttl is None or now - created <= self.ttl:
+                loaded.append(((keys["models"][model_index], query), (created, embedding)))
+        with self.lock:
+            for key, entry in loaded[-self.max_size:]:
+                self.entries[key] = entry
+
+
+class RerankCache:
+    """-------------------------------------------
+    A bounded LRU cache of rerank results.
+
+    Entries are keyed on the normalized query, the rerank model, top_n and
+    the ordered candidate chunk ids. The cache is tied to one index
+    snapshot version, and is emptied when it is used with another one,
+    since the same chunk ids then point at different texts.
+
+    Parameters:
+    max_size (int): The number of entries kept, the least recently used are evicted first.
+    ----------------------------------------------"""
+    def __init__(self, max_size: int = 4096):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.version = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Returns the cached order of the candidates (positions in doc_ids), or None on a miss.
+    def get(self, version: str, model: str, query: str, doc_ids, top_n: int) -> Optional[List[int]]:
+        key = (model, normalize_query(query), top_n, tuple(int(doc_id) for doc_id in doc_ids))
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+            order = self.entries.get(key)
+            if order is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return list(order)
+
+    def put(self, version: str, model: str, query: str, doc_ids, top_n: int, order: List[int]) -> None:
+        key = (model, normalize_query(query), top_n, tuple(int(doc_id) for doc_id in doc_ids))
+        with self.lock:
+            if version == self.version:
+                self.entries[key] = tuple(order)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self.entries),
+            }
+
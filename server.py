@@ -0,0 +1,250 @@
+import argparse
+import asyncio
+import importlib
+import json
+import os
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+from chatEngine import ChatEngine
+
+# The scripts a server can be started over, each has a build_chatbot().
+APPS = {
+    "cohere": "cohereEmbedding",
+    "berel": "berelEmbedding",
+    "nisayon": "nisayon",
+    "story": "storyCohere",
+}
+
+MAX_BODY_BYTES = 1 << 20
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+# Turns an event or response object into something json.dumps can write.
+def to_json(value):
+    if isinstance(value, dict):
+        return {key: to_json(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json(item) for item in value]
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    if hasattr(value, "__dict__"):
+        return {key: to_json(item) for key, item in vars(value).items() if not key.startswith("_")}
+    return str(value)
+
+
+# The fields of a chat event that are sent to the client, keyed by its type name. The final response
+# carries the engine's conversation id, the one the client continues the conversation with.
+def event_data(event, conversation_id: str) -> dict:
+    stream_type = type(event).__name__
+    if stream_type == "StreamTextGeneration":
+        return {"text": event.text}
+    if stream_type == "StreamCitationGeneration":
+        return {"citations": to_json(event.citations)}
+    if stream_type == "StreamingChat":
+        return {
+            "text": getattr(event, "text", None),
+            "conversation_id": conversation_id,
+            "citations": to_json(getattr(event, "citations", None)),
+            "documents": to_json(getattr(event, "documents", None)),
+        }
+    return to_json(event)
+
+
+def sse(event_type: str, data) -> bytes:
+    return f"event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+class Server:
+    """-------------------------------------------
+    A small HTTP server over one warm Chatbot.
+
+    The index is built (or loaded from its snapshot) once at start up and
+    every request shares it. Requests are handled concurrently on the event
+    loop, the blocking work runs on the ChatEngine's thread pool.
+
+    Endpoints:
+    GET /health: The index size and cache statistics.
+    POST /retrieve {"query": str} or {"queries": [str]}: The retrieved documents as JSON.
+    POST /chat {"message": str, "conversation_id": str}: The answer as server-sent events,
+    one event per chat engine event, named after its type.
+
+    Parameters:
+    chatbot: The Chatbot to serve.
+    max_workers (int): The most blocking calls running at the same time.
+    max_idle (float): Seconds after which an idle conversation is forgotten.
+    ----------------------------------------------"""
+    def __init__(self, chatbot, max_workers: int = 32, max_idle: float = 3600.0):
+        self.chatbot = chatbot
+        self.engine = ChatEngine(chatbot, max_workers=max_workers)
+        self.max_idle = max_idle
+
+    async def serve(self, host: str, port: int) -> None:
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Serving on http://{host}:{port}")
+        pruner = asyncio.create_task(self.prune_conversations())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            pruner.cancel()
+
+    # Forgets idle conversations every few minutes, so a long-running server does not keep every id it saw.
+    async def prune_conversations(self) -> None:
+        while True:
+            await asyncio.sleep(min(self.max_idle, 300.0))
+            self.engine.prune(self.max_idle)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            try:
+                method, path, body = await self.read_request(reader)
+                if path == "/health":
+                    await self.health(writer, method)
+                elif path == "/retrieve":
+                    await self.retrieve(writer, method, body)
+                elif path == "/chat":
+                    await self.chat(writer, method, body)
+                else:
+                    raise HttpError(404, f"No endpoint at {path}.")
+            except HttpError as error:
+                await self.send_json(writer, error.status, {"error": str(error)})
+            except (ConnectionError, asyncio.IncompleteReadError):
+                pass
+            except Exception as error:
+                await self.send_json(writer, 500, {"error": repr(error)})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    # Reads the request line, the headers and the body of one request.
+    async def read_request(self, reader: asyncio.StreamReader) -> Tuple[str, str, Optional[dict]]:
+        request_line = (await reader.readline()).decode("latin-1").split()
+        if len(request_line) != 3:
+            raise HttpError(400, "Malformed request line.")
+        method, target, _ = request_line
+
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1")
+            if line in ("\r\n", "\n", ""):
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            raise HttpError(400, "Malformed Content-Length.")
+        if length > MAX_BODY_BYTES:
+            raise HttpError(413, "The request body is too large.")
+        body = None
+        if length:
+            try:
+                body = json.loads(await reader.readexactly(length))
+            except ValueError:
+                raise HttpError(400, "The request body is not valid JSON.")
+            if not isinstance(body, dict):
+                raise HttpError(400, "The request body must be a JSON object.")
+        return method.upper(), urlsplit(target).path, body
+
+    async def health(self, writer: asyncio.StreamWriter, method: str) -> None:
+        if method != "GET":
+            raise HttpError(405, "Use GET.")
+        documents = self.chatbot.docs
+        await self.send_json(writer, 200, {
+            "documents": len(documents.docs),
+            "version": documents.version,
+            "conversations": len(self.engine.conversations),
+            "query_cache": documents.query_cache.stats(),
+            "rerank_cache": documents.rerank_cache.stats(),
+            "response_cache": self.chatbot.response_cache.stats(),
+            "planner": self.chatbot.planner.stats(),
+        })
+
+    async def retrieve(self, writer: asyncio.StreamWriter, method: str, body: Optional[dict]) -> None:
+        if method != "POST":
+            raise HttpError(405, "Use POST.")
+        body = body or {}
+        queries = body.get("queries") or ([body["query"]] if body.get("query") else [])
+        if not isinstance(queries, list) or not queries or not all(isinstance(query, str) for query in queries):
+            raise HttpError(400, "Send a 'query' string or a 'queries' list of strings.")
+        results = await self.engine.run_blocking(self.chatbot.docs.retrieve_many, queries)
+        await self.send_json(writer, 200, {"results": [{"query": query, "documents": documents}
+                                                       for query, documents in zip(queries, results)]})
+
+    async def chat(self, writer: asyncio.StreamWriter, method: str, body: Optional[dict]) -> None:
+        if method != "POST":
+            raise HttpError(405, "Use POST.")
+        body = body or {}
+        message = body.get("message")
+        if not isinstance(message, str) or not message.strip():
+            raise HttpError(400, "Send a 'message' string.")
+        conversation_id = body.get("conversation_id")
+        if conversation_id is not None and not isinstance(conversation_id, str):
+            raise HttpError(400, "The 'conversation_id' must be a string.")
+        state = self.engine.conversation(conversation_id)
+
+        writer.write(self.head(200, {"Content-Type": "text/event-stream; charset=utf-8",
+                                     "Cache-Control": "no-cache"}))
+        writer.write(sse("conversation", {"conversation_id": state.conversation_id}))
+        await writer.drain()
+
+        events = self.engine.respond(state.conversation_id, message)
+        try:
+            async for event in events:
+                writer.write(sse(type(event).__name__, event_data(event, state.conversation_id)))
+                await writer.drain()
+        except ConnectionError:
+            # The client went away, closing the generator releases the conversation.
+            pass
+        except Exception as error:
+            writer.write(sse("error", {"error": repr(error)}))
+            await writer.drain()
+        finally:
+            await events.aclose()
+        writer.write(sse("done", {}))
+        await writer.drain()
+
+    def head(self, status: int, headers: Dict[str, str]) -> bytes:
+        lines = [f"HTTP/1.1 {status} {REASONS.get(status, '')}", "Connection: close"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    async def send_json(self, writer: asyncio.StreamWriter, status: int, data) -> None:
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        writer.write(self.head(status, {"Content-Type": "application/json; charset=utf-8",
+                                        "Content-Length": str(len(body))}))
+        writer.write(body)
+        await writer.drain()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves a chatbot over HTTP with server-sent events.")
+    parser.add_argument("--app", default="cohere", choices=sorted(APPS))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-workers", type=int, default=32)
+    parser.add_argument("--cohere-url", help="Sends the Cohere calls to this URL, e.g. a local stub.")
+    args = parser.parse_args()
+
+    # Must be set before the Cohere client is first created.
+    if args.cohere_url:
+        os.environ["CO_API_URL"] = args.cohere_url
+
+    chatbot = importlib.import_module(APPS[args.app]).build_chatbot()
+    asyncio.run(Server(chatbot, max_workers=args.max_workers).serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import sys
+import time
+from typing import Dict, List, Optional, TextIO
+
+# A citation that arrives at most this many characters after the end of the text it
+# cites gets its marker printed inline, the others only in the list after the answer.
+INLINE_SLACK = 8
+# The citation_quality of the streaming co.chat calls. With "fast" the citations arrive
+# right after the text they cite, with the default "accurate" only after the whole text,
+# too late for any inline marker.
+CITATION_QUALITY = "fast"
+
+
+# Reads a field of a citation or document, the cohere SDK returns both dicts and objects.
+def field(item, name: str, default=None):
+    if isinstance(item, dict):
+        return item.get(name, default)
+    return getattr(item, name, default)
+
+
+class StreamRenderer:
+    """-------------------------------------------
+    Writes a co.chat stream to the terminal as it arrives.
+
+    Every text chunk is written and flushed the moment it is received.
+    Cited documents are numbered in the order they are first cited, and
+    a citation marker like [1] is written inline when the citation follows
+    the text it cites, as it does with CITATION_QUALITY. A citation that
+    arrives after more text, e.g. all of them at the end of an "accurate"
+    stream, is only marked in the list. The cited spans, the documents and
+    the timings are listed after the answer.
+
+    Parameters:
+    out (TextIO): Where to write, stdout by default.
+    clock: Returns the current time in seconds.
+    ----------------------------------------------"""
+    def __init__(self, out: Optional[TextIO] = None, clock=time.perf_counter):
+        self.out = out or sys.stdout
+        self.clock = clock
+        self.start()
+
+    # Resets the renderer for a new answer, the time to first token is measured from here.
+    def start(self) -> None:
+        self.started = self.clock()
+        self.first_token = None
+        self.finished = None
+        self.written = 0
+        self.citations = []
+        self.document_numbers: Dict[str, int] = {}
+
+    def write(self, text: str) -> None:
+        self.out.write(text)
+        self.out.flush()
+
+    def text(self, text: str) -> None:
+        if self.first_token is None:
+            self.first_token = self.clock()
+        self.write(text)
+        self.written += len(text)
+
+    # The marker of a citation, e.g. [1,3], numbering its documents on first sight.
+    def marker(self, citation) -> str:
+        numbers = []
+        for document_id in field(citation, "document_ids", []) or []:
+            if document_id not in self.document_numbers:
+                self.document_numbers[document_id] = len(self.document_numbers) + 1
+            numbers.append(self.document_numbers[document_id])
+        return "[" + ",".join(str(number) for number in numbers) + "]"
+
+    def citation(self, citation) -> None:
+        marker = self.marker(citation)
+        self.citations.append((citation, marker))
+        end = field(citation, "end")
+        if end is not None and self.written - end <= INLINE_SLACK:
+            self.write(marker)
+
+    # Handles one event of a co.chat stream.
+    def render(self, event) -> None:
+        stream_type = type(event).__name__
+        if stream_type == "StreamTextGeneration":
+            self.text(event.text)
+        elif stream_type == "StreamCitationGeneration":
+            for citation in event.citations:
+                self.citation(citation)
+        elif stream_type == "StreamingChat":
+            self.finish(event.documents)
+
+    # Lists the cited spans and documents, then the timings.
+    def finish(self, documents: Optional[List[dict]] = None) -> None:
+        self.finished = self.clock()
+        if self.citations:
+            self.write("\n\nCITATIONS:\n")
+            for citation, marker in self.citations:
+                self.write(f"{field(citation, 'text')} {marker}\n")
+
+        cited = [document for document in documents or []
+                 if field(document, "id") in self.document_numbers]
+        if cited:
+            self.write("\nDOCUMENTS:\n")
+            for document in sorted(cited, key=lambda document: self.document_numbers[field(document, "id")]):
+                text = field(document, "text", "")
+                self.write(f"[{self.document_numbers[field(document, 'id')]}] {field(document, 'title')}: "
+                           f"{text[:50]}{'...' if len(text) > 50 else ''}\n")
+
+        metrics = self.metrics()
+        ttft = "-" if metrics["ttft"] is None else f"{metrics['ttft']:.2f}s"
+        self.write(f"\n(time to first token {ttft}, total {metrics['total']:.2f}s)\n")
+
+    # The time to first token and the total time of the answer, in seconds.
+    def metrics(self) -> Dict[str, Optional[float]]:
+        end = self.finished if self.finished is not None else self.clock()
+        return {
+            "ttft": None if self.first_token is None else self.first_token - self.started,
+            "total": end - self.started,
+        }
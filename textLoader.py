@@ -0,0 +1,81 @@
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Iterator, Tuple, Callable
+
+# Below this many bytes in total a process pool costs more to start than it saves.
+POOL_MIN_BYTES = 1 << 20
+
+VERSE_MARKER = re.compile(r"(?=\{[א-ת]+\})")
+SENTENCE_END = re.compile(r"(?<=[.!?:])\s+")
+TITLE_MAX_CHARACTERS = 80
+
+
+# The sources use Windows paths ("bereshit\\bereshit 1.txt"), this makes them work on any OS.
+def local_path(file_name: str) -> str:
+    return os.path.join(*file_name.replace("\\", "/").split("/"))
+
+
+def is_plain_text(source: Dict[str, str]) -> bool:
+    return source["fileName"].lower().endswith(".txt")
+
+
+# A line is a title if it is short and is not running text, e.g. "בראשית פרק-א" or "פרשת לך לך".
+def is_title(line: str) -> bool:
+    return len(line) <= TITLE_MAX_CHARACTERS and "{" not in line and not re.search(r"[.!?:,;\"'״]$", line)
+
+
+# Streams a file line by line and groups it into (title, lines) sections.
+def read_sections(file_name: str) -> Iterator[Tuple[str, List[str]]]:
+    title, lines = "", []
+    with open(local_path(file_name), encoding="utf-8-sig") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if is_title(line):
+                if lines:
+                    yield title, lines
+                    title, lines = line, []
+                else:
+                    title = title + "\n" + line if title else line
+            else:
+                lines.append(line)
+    if lines or title:
+        yield title, lines
+
+
+# Splits running text into units that should not be cut: verses if the text has {א} markers, sentences otherwise.
+def split_units(line: str) -> List[str]:
+    pattern = VERSE_MARKER if VERSE_MARKER.search(line) else SENTENCE_END
+    return [unit.strip() for unit in pattern.split(line) if unit.strip()]
+
+
+"""-------------------------------------------
+Loads and chunks plain-text sources, spreading the files over a process
+pool when there is enough text to make it worth it.
+
+Parameters:
+sources (List[Dict[str, str]]): The sources to load.
+chunk (Callable): Chunks a single source, e.g. verseChunker.VerseChunker().chunk. Must pickle to run in the pool.
+processes (int): Number of worker processes, None to decide by total size, 1 to stay in-process.
+
+Returns:
+List[Dict[str, str]]: The chunk records of all sources, in source order.
+----------------------------------------------"""
+def load_sources(sources: List[Dict[str, str]], chunk: Callable[[Dict[str, str]], List[Dict]],
+                 processes: int = None) -> List[Dict[str, str]]:
+    if processes is None:
+        total_bytes = sum(os.path.getsize(local_path(source["fileName"])) for source in sources)
+        processes = os.cpu_count() if total_bytes >= POOL_MIN_BYTES else 1
+
+    if processes <= 1 or len(sources) <= 1:
+        per_file = [chunk(source) for source in sources]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            per_file = list(executor.map(chunk, sources, chunksize=max(1, len(sources) // (processes * 4))))
+
+    docs = []
+    for chunks in per_file:
+        docs.extend(chunks)
+    return docs
@@ -0,0 +1,161 @@
+import argparse
+import importlib
+import json
+import os
+import re
+from typing import List, Optional
+
+import rerankGate
+
+# Kept in the snapshot directory, the similarities are measured against its embeddings.
+CLASSIFIER_FILE = "topic_classifier.json"
+# Where a message is split into separate search queries.
+SENTENCE_END = re.compile(r"[?!.\n]+")
+
+
+# The search queries of a message without the LLM: its sentences, one query each.
+def extract_queries(message: str) -> List[str]:
+    return [sentence.strip() for sentence in SENTENCE_END.split(message) if sentence.strip()]
+
+
+class TopicClassifier:
+    """-------------------------------------------
+    Decides locally whether a message is about the corpus, before the LLM is asked.
+
+    The message is compared with its nearest chunk: from on_topic similarity
+    up it is on topic, up to off_topic it is not, and in between the
+    classifier is unsure and the LLM plans the message. A message in between
+    that is a chapter reference the lexical index can look up (פרק-יב) is on
+    topic too. Rare words are not enough, short everyday questions such as
+    מה השעה also match a few chunks. A classifier without thresholds is
+    unsure of everything.
+
+    Parameters:
+    docs (ragPipeline.Documents): The indexed corpus.
+    on_topic (float): The similarity from which a message is on topic, None if not calibrated.
+    off_topic (float): The similarity up to which a message is off topic, None if not calibrated.
+    ----------------------------------------------"""
+    def __init__(self, docs, on_topic: Optional[float] = None, off_topic: Optional[float] = None):
+        self.docs = docs
+        self.on_topic = on_topic
+        self.off_topic = off_topic
+
+    # The cosine similarity of the message and its nearest chunk.
+    def similarity(self, message: str) -> float:
+        distances = self.docs.dense([message])[1]
+        return 1.0 - float(distances[0][0]) if len(distances[0]) else 0.0
+
+    """-------------------------------------------
+    Plans a message locally, used as the classify step of queryPlanner.QueryPlanner.
+
+    Parameters:
+    message (str): The user's message.
+
+    Returns:
+    List[str]: The search queries, empty for an off-topic message, or None
+    if the classifier is unsure and the LLM should plan the message.
+    ----------------------------------------------"""
+    def classify(self, message: str) -> Optional[List[str]]:
+        if self.on_topic is None or self.off_topic is None:
+            return None
+        similarity = self.similarity(message)
+        if similarity <= self.off_topic:
+            return []
+        if similarity >= self.on_topic or self.docs.lexical.lookup(message, self.docs.rerank_top_k) is not None:
+            return extract_queries(message)
+        return None
+
+    def to_dict(self) -> dict:
+        return {"on_topic": self.on_topic, "off_topic": self.off_topic}
+
+
+# The classifier of a corpus with the thresholds calibrated for its snapshot, unsure of everything if there are none.
+def load(docs) -> TopicClassifier:
+    if docs.snapshot_path is None:
+        return TopicClassifier(docs)
+    classifier_file = os.path.join(docs.snapshot_path, CLASSIFIER_FILE)
+    if not os.path.exists(classifier_file):
+        return TopicClassifier(docs)
+    with open(classifier_file, encoding="utf-8") as f:
+        return TopicClassifier(docs, **json.load(f))
+
+
+def save(classifier: TopicClassifier) -> None:
+    with open(os.path.join(classifier.docs.snapshot_path, CLASSIFIER_FILE), "w", encoding="utf-8") as f:
+        json.dump(classifier.to_dict(), f, indent=2)
+
+
+"""-------------------------------------------
+Calibrates the thresholds of a classifier on labeled messages.
+
+on_topic is the lowest similarity from which the given share of the
+messages are really on topic, and off_topic the highest similarity up to
+which that share are really off topic. Messages between the two go to the
+LLM, so a higher precision sends more of them there.
+
+Parameters:
+classifier (TopicClassifier): The classifier to calibrate, over a corpus after lei().
+on_topic (List[str]): Messages about the corpus.
+off_topic (List[str]): Messages that are not.
+precision (float): The share of correct decisions on each side.
+
+Returns:
+Dict: The thresholds and the share of the messages decided locally.
+----------------------------------------------"""
+def calibrate(classifier: TopicClassifier, on_topic: List[str], off_topic: List[str],
+              precision: float = 0.95) -> dict:
+    similarities = [classifier.similarity(message) for message in on_topic + off_topic]
+    labels = [True] * len(on_topic) + [False] * len(off_topic)
+    classifier.on_topic = rerankGate.threshold(similarities, labels, precision)
+    # The same search from the other end: the lowest negated similarity that is mostly off topic.
+    lowest = rerankGate.threshold([-similarity for similarity in similarities], [not label for label in labels],
+                                  precision)
+    classifier.off_topic = None if lowest is None else -lowest
+
+    # The classifier only decides once both thresholds are found.
+    calibrated = classifier.on_topic is not None and classifier.off_topic is not None
+    decided = [calibrated and (similarity >= classifier.on_topic or similarity <= classifier.off_topic)
+               for similarity in similarities]
+    return dict(classifier.to_dict(), messages=len(similarities), local=sum(decided) / len(similarities))
+
+
+# Questions that are not about Bereshit, used when no off-topic file is given.
+OFF_TOPIC_SAMPLES = [
+    "מה מזג האוויר מחר בתל אביב",
+    "איך מכינים עוגת שוקולד",
+    "מי ניצח במשחק הכדורגל אתמול",
+    "כמה עולה כרטיס טיסה לאילת",
+    "איך מתקינים פייתון על ווינדוס",
+    "מה ההבדל בין מניה לאג\"ח",
+    "תמליץ לי על סדרה טובה בנטפליקס",
+    "מתי נפתחת ההרשמה לאוניברסיטה",
+    "איך מחליפים צמיג באוטו",
+    "מה השעה עכשיו בניו יורק",
+]
+
+
+if __name__ == "__main__":
+    import rerankers
+    import server
+
+    parser = argparse.ArgumentParser(description="Calibrates the local topic classifier of an app.")
+    parser.add_argument("--app", default="cohere", choices=sorted(server.APPS))
+    parser.add_argument("--on-topic", help="A file with one on-topic message per line.")
+    parser.add_argument("--off-topic", help="A file with one off-topic message per line.")
+    parser.add_argument("--precision", type=float, default=0.95)
+    args = parser.parse_args()
+
+    def read_lines(file_name, default):
+        if not file_name:
+            return default
+        with open(file_name, encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip()]
+
+    corpus = importlib.import_module(server.APPS[args.app]).build_chatbot().docs
+    classifier = TopicClassifier(corpus)
+    report = calibrate(classifier, read_lines(args.on_topic, rerankers.SAMPLE_QUERIES),
+                       read_lines(args.off_topic, OFF_TOPIC_SAMPLES), args.precision)
+    save(classifier)
+    print(f"on_topic={report['on_topic']}, off_topic={report['off_topic']}: {report['local']:.0%} of "
+          f"{report['messages']} messages planned without the LLM. Saved to "
+          f"{os.path.join(corpus.snapshot_path, CLASSIFIER_FILE)}")
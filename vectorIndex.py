@@ -0,0 +1,450 @@
+import argparse
+import os
+import time
+from typing import Dict, List
+
+import hnswlib
+import numpy as np
+
+# Up to this many chunks an exact scan is cheaper than building and searching an HNSW graph:
+# one matrix product over a few thousand rows takes well under a millisecond.
+EXACT_MAX_ELEMENTS = 20000
+
+# How the exact index stores its vectors, see ExactIndex.
+STORAGE_DTYPES = ("float32", "float16", "int8")
+
+# Rows of compressed vectors widened to float32 at a time while scoring.
+SCORE_BLOCK_ROWS = 4096
+
+# A compressed index returns this many times k candidates, which are then rescored with the full vectors.
+RESCORE_OVERSAMPLE = 4
+
+
+# Scales every row to unit length, so inner product ranks by cosine similarity.
+def normalize(embeddings) -> np.ndarray:
+    embeddings = np.array(embeddings, dtype=np.float32, ndmin=2)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(embeddings / norms)
+
+
+"""-------------------------------------------
+Reorders candidates by their exact inner product with the query.
+
+Parameters:
+embeddings: The full float32 embeddings, row i has label i. A memory-mapped
+matrix works, only the candidate rows are read.
+queries (np.ndarray): The query embeddings.
+labels (np.ndarray): The candidate labels of every query.
+k (int): How many candidates to keep per query.
+
+Returns:
+Tuple: (labels, distances) of the best k candidates, nearest first.
+----------------------------------------------"""
+def rescore(embeddings, queries: np.ndarray, labels: np.ndarray, k: int):
+    labels = np.asarray(labels, dtype=np.int64)
+    scores = np.einsum("qd,qcd->qc", queries, np.asarray(embeddings[labels.ravel()], dtype=np.float32)
+                       .reshape(labels.shape[0], labels.shape[1], -1))
+    order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+    return (np.take_along_axis(labels, order, axis=1).astype(np.uint64),
+            (1.0 - np.take_along_axis(scores, order, axis=1)).astype(np.float32))
+
+
+class VectorIndex:
+    """-------------------------------------------
+    The interface of a nearest-neighbour index over inner product.
+
+    Labels are the positions of the chunks in Documents.docs. The method
+    names follow hnswlib, so corpusSnapshot can save, load and refresh any
+    implementation the same way.
+    ----------------------------------------------"""
+    # Recorded in the snapshot meta so a snapshot is loaded back into the same kind of index.
+    kind = None
+
+    def __init__(self, dim: int):
+        self.dim = dim
+
+    # Allocates an empty index with room for max_elements vectors.
+    def init_index(self, max_elements: int) -> None:
+        raise NotImplementedError
+
+    def add_items(self, embeddings, labels: List[int]) -> None:
+        raise NotImplementedError
+
+    # Returns (labels, distances), one row per query, nearest first. The distance is 1 - inner product.
+    def knn_query(self, embeddings, k: int):
+        raise NotImplementedError
+
+    # Tombstones a label, it is never returned by knn_query again.
+    def mark_deleted(self, label: int) -> None:
+        raise NotImplementedError
+
+    def resize_index(self, max_elements: int) -> None:
+        raise NotImplementedError
+
+    def get_max_elements(self) -> int:
+        raise NotImplementedError
+
+    def get_current_count(self) -> int:
+        raise NotImplementedError
+
+    def save_index(self, path: str) -> None:
+        raise NotImplementedError
+
+    def load_index(self, path: str, max_elements: int) -> None:
+        raise NotImplementedError
+
+    # The construction and search parameters, kept in the snapshot meta and passed back to create_index.
+    def params(self) -> Dict[str, int]:
+        return {}
+
+    # True if knn_query ranks approximations of the added vectors, whose results are worth rescoring.
+    def quantized(self) -> bool:
+        return False
+
+    # The memory the index holds, in bytes.
+    def memory_bytes(self) -> int:
+        raise NotImplementedError
+
+    # Builds the index over an embedding matrix, row i gets label i.
+    def build(self, embeddings) -> None:
+        self.init_index(len(embeddings))
+        self.add_items(embeddings, list(range(len(embeddings))))
+
+
+class HnswIndex(VectorIndex):
+    """-------------------------------------------
+    An approximate index backed by hnswlib.
+
+    Parameters:
+    dim (int): The embedding dimension.
+    M (int): The number of links per node.
+    ef_construction (int): The size of the candidate list while building.
+    ef (int): The size of the candidate list while searching, never below k.
+    ----------------------------------------------"""
+    kind = "hnsw"
+
+    def __init__(self, dim: int, M: int = 64, ef_construction: int = 512, ef: int = 64):
+        super().__init__(dim)
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef = ef
+        self.index = hnswlib.Index(space="ip", dim=dim)
+
+    def init_index(self, max_elements: int) -> None:
+        self.index.init_index(max_elements=max_elements, ef_construction=self.ef_construction, M=self.M)
+        self.index.set_ef(self.ef)
+
+    # hnswlib searches with max(ef, k) candidates.
+    def set_ef(self, ef: int) -> None:
+        self.ef = ef
+        self.index.set_ef(ef)
+
+    def add_items(self, embeddings, labels: List[int]) -> None:
+        self.index.add_items(np.asarray(embeddings, dtype=np.float32), labels)
+
+    def knn_query(self, embeddings, k: int):
+        return self.index.knn_query(np.asarray(embeddings, dtype=np.float32), k=k)
+
+    def mark_deleted(self, label: int) -> None:
+        self.index.mark_deleted(label)
+
+    def resize_index(self, max_elements: int) -> None:
+        self.index.resize_index(max_elements)
+
+    def get_max_elements(self) -> int:
+        return self.index.get_max_elements()
+
+    def get_current_count(self) -> int:
+        return self.index.get_current_count()
+
+    def save_index(self, path: str) -> None:
+        self.index.save_index(path)
+
+    def load_index(self, path: str, max_elements: int) -> None:
+        self.index.load_index(path, max_elements=max_elements)
+        # hnswlib does not save ef with the graph.
+        self.index.set_ef(self.ef)
+
+    def params(self) -> Dict[str, int]:
+        return {"M": self.M, "ef_construction": self.ef_construction, "ef": self.ef}
+
+    # The size of the saved graph in bytes, close to its size in memory.
+    def memory_bytes(self) -> int:
+        return self.index.index_file_size()
+
+
+class ExactIndex(VectorIndex):
+    """-------------------------------------------
+    An exact index that scores every chunk with one matrix product.
+
+    There is no graph to build, so indexing is a copy, and every query
+    returns the true nearest neighbours of the stored vectors. The search
+    is linear in the number of chunks, which is the right trade for small
+    corpora.
+
+    The vectors can be stored compressed. float16 halves the memory, and
+    int8 (one scale per row) quarters it. Their rankings are close to,
+    but not exactly, the float32 ones, so callers rescore an oversampled
+    candidate list with the full vectors (see rescore).
+
+    Parameters:
+    dim (int): The embedding dimension.
+    dtype (str): One of STORAGE_DTYPES.
+    ----------------------------------------------"""
+    kind = "exact"
+
+    def __init__(self, dim: int, dtype: str = "float32"):
+        super().__init__(dim)
+        if dtype not in STORAGE_DTYPES:
+            raise ValueError(f"Unknown storage '{dtype}', expected one of {', '.join(STORAGE_DTYPES)}.")
+        self.dtype = dtype
+        self.init_index(0)
+
+    def init_index(self, max_elements: int) -> None:
+        self.vectors = np.zeros((max_elements, self.dim), dtype=self.dtype)
+        self.scales = np.ones(max_elements, dtype=np.float32)
+        self.added = np.zeros(max_elements, dtype=bool)
+        self.deleted = np.zeros(max_elements, dtype=bool)
+
+    # True if the stored vectors are an approximation of the added ones.
+    def quantized(self) -> bool:
+        return self.dtype != "float32"
+
+    def add_items(self, embeddings, labels: List[int]) -> None:
+        labels = np.asarray(labels, dtype=np.int64)
+        if not labels.size:
+            return
+        if labels.max() >= len(self.vectors):
+            self.resize_index(int(labels.max()) + 1)
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(labels), self.dim)
+        if self.dtype == "int8":
+            scales = np.abs(embeddings).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            self.vectors[labels] = np.round(embeddings / scales[:, None]).astype(np.int8)
+            self.scales[labels] = scales
+        else:
+            self.vectors[labels] = embeddings
+        self.added[labels] = True
+        self.deleted[labels] = False
+
+    # The inner products of the queries with every stored vector. Compressed vectors are
+    # widened to float32 a block at a time, so the matrix product still runs on BLAS
+    # without a float32 copy of the whole matrix.
+    def scores(self, queries: np.ndarray) -> np.ndarray:
+        if not self.quantized():
+            return queries @ self.vectors.T
+        scores = np.empty((len(queries), len(self.vectors)), dtype=np.float32)
+        for start in range(0, len(self.vectors), SCORE_BLOCK_ROWS):
+            block = slice(start, start + SCORE_BLOCK_ROWS)
+            scores[:, block] = (queries @ self.vectors[block].astype(np.float32).T) * self.scales[block]
+        return scores
+
+    # Same contract as hnswlib: uint64 labels and float32 distances (1 - inner product), nearest first.
+    def knn_query(self, embeddings, k: int):
+        queries = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        live = self.added & ~self.deleted
+        if k > int(live.sum()):
+            raise RuntimeError(f"Cannot return {k} neighbours from {int(live.sum())} live elements.")
+
+        scores = self.scores(queries)
+        scores[:, ~live] = -np.inf
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        labels = np.take_along_axis(top, order, axis=1)
+        distances = 1.0 - np.take_along_axis(top_scores, order, axis=1)
+        return labels.astype(np.uint64), distances.astype(np.float32)
+
+    def mark_deleted(self, label: int) -> None:
+        self.deleted[label] = True
+
+    def resize_index(self, max_elements: int) -> None:
+        grow = max_elements - len(self.vectors)
+        if grow <= 0:
+            return
+        self.vectors = np.vstack([self.vectors, np.zeros((grow, self.dim), dtype=self.dtype)])
+        self.scales = np.concatenate([self.scales, np.ones(grow, dtype=np.float32)])
+        self.added = np.concatenate([self.added, np.zeros(grow, dtype=bool)])
+        self.deleted = np.concatenate([self.deleted, np.zeros(grow, dtype=bool)])
+
+    def get_max_elements(self) -> int:
+        return len(self.vectors)
+
+    # Like hnswlib, deleted elements still count.
+    def get_current_count(self) -> int:
+        return int(self.added.sum())
+
+    def save_index(self, path: str) -> None:
+        with open(path, "wb") as f:
+            np.savez(f, vectors=self.vectors, scales=self.scales, added=self.added, deleted=self.deleted)
+
+    def load_index(self, path: str, max_elements: int) -> None:
+        with np.load(path) as saved:
+            self.vectors = saved["vectors"].astype(self.dtype, copy=False)
+            self.scales = saved["scales"] if "scales" in saved else np.ones(len(self.vectors), dtype=np.float32)
+            self.added = saved["added"]
+            self.deleted = saved["deleted"]
+        self.resize_index(max_elements)
+
+    def params(self) -> Dict[str, str]:
+        return {"dtype": self.dtype}
+
+    def memory_bytes(self) -> int:
+        return self.vectors.nbytes + self.scales.nbytes
+
+
+INDEXES = {ExactIndex.kind: ExactIndex, HnswIndex.kind: HnswIndex}
+
+
+"""-------------------------------------------
+Creates an empty index.
+
+Parameters:
+kind (str): "exact", "hnsw", or "auto" to pick by corpus size.
+dim (int): The embedding dimension.
+count (int): The number of chunks that will be indexed, used by "auto".
+params: The construction and search parameters of the index, see VectorIndex.params.
+
+Returns:
+VectorIndex: The new index.
+----------------------------------------------"""
+def create_index(kind: str, dim: int, count: int = 0, **params) -> VectorIndex:
+    return INDEXES[resolve_kind(kind, count)](dim, **params)
+
+
+# The index kind to build, "auto" picks the exact index for corpora up to EXACT_MAX_ELEMENTS chunks.
+def resolve_kind(kind: str, count: int = 0) -> str:
+    if kind == "auto":
+        kind = ExactIndex.kind if count <= EXACT_MAX_ELEMENTS else HnswIndex.kind
+    if kind not in INDEXES:
+        raise ValueError(f"Unknown index '{kind}', expected auto or one of {', '.join(INDEXES)}.")
+    return kind
+
+
+"""-------------------------------------------
+Measures how many of the true nearest neighbours an index finds.
+
+Parameters:
+index (VectorIndex): The index to check, usually an HnswIndex.
+embeddings: The indexed embeddings, row i has label i.
+queries: The query embeddings.
+k (int): The number of neighbours compared.
+
+Returns:
+float: The mean recall@k against an exact scan.
+----------------------------------------------"""
+def recall_at_k(index: VectorIndex, embeddings, queries, k: int = 10) -> float:
+    exact = ExactIndex(index.dim)
+    exact.build(embeddings)
+    k = min(k, len(embeddings))
+    expected = exact.knn_query(queries, k)[0]
+    found = index.knn_query(queries, k)[0]
+    return float(np.mean([len(set(a.tolist()) & set(b.tolist())) / k for a, b in zip(expected, found)]))
+
+
+# A random sample of the embeddings, used as stand-in queries when no real ones are at hand.
+def sample_queries(embeddings, sample: int = 200, seed: int = 0) -> np.ndarray:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    rows = np.random.default_rng(seed).choice(len(embeddings), size=min(sample, len(embeddings)), replace=False)
+    return embeddings[rows]
+
+
+# The recall@k of an index, queried with a random sample of its own embeddings.
+def sample_recall(index: VectorIndex, embeddings, k: int = 10, sample: int = 200, seed: int = 0) -> float:
+    return recall_at_k(index, embeddings, sample_queries(embeddings, sample, seed), k)
+
+
+# The candidate HNSW settings, tried cheapest first.
+TUNE_M = (8, 16, 32, 48, 64)
+TUNE_EF_CONSTRUCTION = (64, 128, 256, 512)
+TUNE_EF = (16, 32, 64, 128, 256, 512)
+
+
+"""-------------------------------------------
+Finds the cheapest HNSW parameters that meet a recall target.
+
+The graphs are built from the smallest M and ef_construction up, since
+those decide build time and memory. For every graph the smallest ef that
+reaches the target is searched for, since ef decides the query latency.
+The first graph that reaches the target wins, so a corpus that is easy
+to search never pays for a dense graph.
+
+Parameters:
+embeddings: The embeddings to index, row i gets label i.
+queries: The tuning queries, ideally real query embeddings. A sample of
+the embeddings is used if None.
+k (int): The number of neighbours the recall is measured on.
+target_recall (float): The mean recall@k the index has to reach.
+
+Returns:
+Tuple: (index, report). The index is built with the chosen parameters.
+The report has the parameters, the recall, the build seconds, the
+per-query milliseconds and the memory bytes. If no candidate reaches the
+target, the one with the best recall is returned.
+----------------------------------------------"""
+def tune_hnsw(embeddings, queries=None, k: int = 10, target_recall: float = 0.95):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    queries = sample_queries(embeddings) if queries is None else np.asarray(queries, dtype=np.float32)
+    k = min(k, len(embeddings))
+
+    exact = ExactIndex(embeddings.shape[1])
+    exact.build(embeddings)
+    expected = exact.knn_query(queries, k)[0]
+
+    best = None
+    for M in TUNE_M:
+        for ef_construction in TUNE_EF_CONSTRUCTION:
+            start = time.perf_counter()
+            index = HnswIndex(embeddings.shape[1], M=M, ef_construction=ef_construction)
+            index.build(embeddings)
+            build_seconds = time.perf_counter() - start
+
+            for ef in TUNE_EF:
+                index.set_ef(max(ef, k))
+                start = time.perf_counter()
+                found = index.knn_query(queries, k)[0]
+                query_ms = (time.perf_counter() - start) / len(queries) * 1000
+                recall = float(np.mean([len(set(a.tolist()) & set(b.tolist())) / k
+                                        for a, b in zip(expected, found)]))
+                report = dict(index.params(), recall=recall, build_seconds=build_seconds, query_ms=query_ms,
+                              memory_bytes=index.memory_bytes())
+                if best is None or recall > best[1]["recall"]:
+                    best = (index, report)
+                if recall >= target_recall:
+                    return index, report
+
+    index, report = best
+    index.set_ef(report["ef"])
+    return index, report
+
+
+if __name__ == "__main__":
+    import corpusSnapshot
+
+    parser = argparse.ArgumentParser(description="Compares the exact and HNSW indexes on a snapshot's embeddings.")
+    parser.add_argument("snapshot", help="A snapshot directory under snapshots/.")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--target-recall", type=float, default=0.95)
+    args = parser.parse_args()
+
+    embs = np.load(os.path.join(args.snapshot, corpusSnapshot.EMBEDDINGS_FILE))
+    sample = sample_queries(embs, args.queries)
+
+    for index_kind in INDEXES:
+        start = time.perf_counter()
+        candidate = create_index(index_kind, embs.shape[1])
+        candidate.build(embs)
+        build_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        for query in sample:
+            candidate.knn_query(query, args.k)
+        query_ms = (time.perf_counter() - start) / len(sample) * 1000
+        print(f"{index_kind}: build {build_seconds:.3f}s, {query_ms:.3f}ms per query, "
+              f"recall@{args.k} {recall_at_k(candidate, embs, sample, args.k):.4f} on {len(embs)} chunks")
+
+    tuned, tuning = tune_hnsw(embs, sample, args.k, args.target_recall)
+    print(f"tuned hnsw: M={tuning['M']} ef_construction={tuning['ef_construction']} ef={tuning['ef']}, "
+          f"build {tuning['build_seconds']:.3f}s, {tuning['query_ms']:.3f}ms per query, "
+          f"{tuning['memory_bytes'] / 2 ** 20:.1f} MiB, recall@{args.k} {tuning['recall']:.4f}")
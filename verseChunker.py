@@ -0,0 +1,155 @@
+import re
+from typing import List, Dict, Callable
+
+import textLoader
+
+CHAPTER_HEADER = re.compile(r"(\S+) פרק-([א-ת]+)")
+VERSE_NUMBER = re.compile(r"^\{([א-ת]+)\}")
+# Bumped when the chunk format changes, so snapshots of the old chunks are rebuilt.
+CHUNK_FORMAT = 2
+
+HEBREW_NUMERALS = {
+    "א": 1, "ב": 2, "ג": 3, "ד": 4, "ה": 5, "ו": 6, "ז": 7, "ח": 8, "ט": 9,
+    "י": 10, "כ": 20, "ך": 20, "ל": 30, "מ": 40, "ם": 40, "נ": 50, "ן": 50, "ס": 60,
+    "ע": 70, "פ": 80, "ף": 80, "צ": 90, "ץ": 90, "ק": 100, "ר": 200, "ש": 300, "ת": 400,
+}
+
+
+# The value of a Hebrew numeral, e.g. "יב" -> 12, "קמו" -> 146.
+def hebrew_numeral(letters: str) -> int:
+    return sum(HEBREW_NUMERALS.get(letter, 0) for letter in letters)
+
+
+# A tokenizer-free token estimate, used with the Cohere embedder which has no local tokenizer.
+# Hebrew words come out at about two tokens each in the multilingual vocabularies.
+def estimate_tokens(text: str) -> int:
+    return 2 * len(text.split())
+
+
+class TokenCounter:
+    # Counts tokens with a Hugging Face tokenizer. A class instead of a lambda so it pickles into loader processes.
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+
+    def __call__(self, text: str) -> int:
+        return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+
+class VerseChunker:
+    """-------------------------------------------
+    Chunks plain-text scripture on verse boundaries.
+
+    Verses of a chapter are packed into chunks up to a token budget, and
+    consecutive chunks share their last verses up to the overlap budget.
+    Each record carries the chapter and the verse range it covers.
+
+    Parameters:
+    count_tokens (Callable): Counts the tokens of a text with the active tokenizer.
+    max_tokens (int): The token budget of a chunk, including the chapter header.
+    overlap_tokens (int): How many tokens of trailing verses are repeated in the next chunk.
+    ----------------------------------------------"""
+    def __init__(self, count_tokens: Callable[[str], int] = estimate_tokens, max_tokens: int = 256,
+                 overlap_tokens: int = 32):
+        self.count_tokens = count_tokens
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+
+    # The parameters that change the chunks, used to key snapshots.
+    def settings(self) -> Dict:
+        counter = getattr(self.count_tokens, "tokenizer", None)
+        return {
+            "chunker": "verse",
+            "format": CHUNK_FORMAT,
+            "tokenizer": getattr(counter, "name_or_path", None) or getattr(self.count_tokens, "__name__", "custom"),
+            "max_tokens": self.max_tokens,
+            "overlap_tokens": self.overlap_tokens,
+        }
+
+    """-------------------------------------------
+    Chunks a single source.
+
+    Parameters:
+    source (Dict[str, str]): The source, with 'title' and 'fileName' keys.
+
+    Returns:
+    List[Dict]: The chunk records, with 'title', 'text', 'fileName', 'chapter',
+    'verse_start' and 'verse_end' keys. The chapter and verses are None for
+    texts without chapter headers and verse markers.
+    ----------------------------------------------"""
+    def chunk(self, source: Dict[str, str]) -> List[Dict]:
+        docs = []
+        chapter, chapter_header = None, None
+        for header, lines in textLoader.read_sections(source["fileName"]):
+            match = CHAPTER_HEADER.search(header)
+            if match:
+                chapter, chapter_header = hebrew_numeral(match.group(2)), match.group(0)
+            elif chapter_header:
+                # A parasha title in the middle of a chapter starts a section of the same chapter.
+                header = chapter_header + "\n" + header if header else chapter_header
+            header_tokens = self.count_tokens(header) if header else 0
+
+            verses = []
+            for line in lines:
+                for unit in textLoader.split_units(line):
+                    number = VERSE_NUMBER.match(unit)
+                    verse = hebrew_numeral(number.group(1)) if number else None
+                    for piece in self.split_long(unit, self.max_tokens - header_tokens):
+                        verses.append((verse, piece, self.count_tokens(piece)))
+
+            for window in self.pack(verses, header_tokens):
+                text = " ".join(piece for _, piece, _ in window)
+                numbers = [verse for verse, _, _ in window if verse is not None]
+                docs.append(
+                    {
+                        "title": source["title"],
+                        "text": header + "\n\n" + text if header else text,
+                        "fileName": source["fileName"],
+                        "chapter": chapter,
+                        "verse_start": min(numbers) if numbers else None,
+                        "verse_end": max(numbers) if numbers else None,
+                    }
+                )
+            if not verses and header:
+                docs.append({"title": source["title"], "text": header, "fileName": source["fileName"],
+                             "chapter": chapter, "verse_start": None, "verse_end": None})
+        return docs
+
+    # Packs (verse, text, tokens) units into windows that fit the budget, with the configured overlap.
+    def pack(self, verses, header_tokens: int) -> List[List]:
+        windows = []
+        window, window_tokens = [], header_tokens
+        for unit in verses:
+            if window and window_tokens + unit[2] > self.max_tokens:
+                windows.append(window)
+                kept, kept_tokens = [], 0
+                for previous in reversed(window[1:]):
+                    if kept_tokens + previous[2] > self.overlap_tokens:
+                        break
+                    kept.insert(0, previous)
+                    kept_tokens += previous[2]
+                while kept and header_tokens + kept_tokens + unit[2] > self.max_tokens:
+                    kept_tokens -= kept.pop(0)[2]
+                window, window_tokens = kept, header_tokens + kept_tokens
+            window.append(unit)
+            window_tokens += unit[2]
+        if window:
+            windows.append(window)
+        return windows
+
+    # Splits a verse that is over the budget on word boundaries.
+    def split_long(self, unit: str, budget: int) -> List[str]:
+        budget = max(1, budget)
+        if self.count_tokens(unit) <= budget:
+            return [unit]
+
+        pieces, words, words_tokens = [], [], 0
+        for word in unit.split():
+            word_tokens = self.count_tokens(word)
+            if words and words_tokens + word_tokens > budget:
+                pieces.append(" ".join(words))
+                words, words_tokens = [], 0
+            words.append(word)
+            words_tokens += word_tokens
+        if words:
+            pieces.append(" ".join(words))
+        return pieces